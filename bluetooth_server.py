@@ -7,6 +7,7 @@ import bluetooth
 
 from cfg import BTPORT
 from utils import logger, usbtool
+from utils.framing import encode_frame
 
 if os.name == "nt":
     raise SystemExit("This program is designed to run only on a Raspberry Device")
@@ -25,7 +26,9 @@ while True:
         print("Found port:", port_chessboard)
         break
 
-usbtool.start_usbtool(port_chessboard, separate_process=True)
+# Forward every reading: repeat counts of unchanged frames cannot be sent in the
+# board format, so the client drops unchanged frames itself
+usbtool.start_usbtool(port_chessboard, separate_process=True, filter_frames=False)
 QUEUE_TO_USBTOOL = usbtool.QUEUE_TO_USBTOOL
 QUEUE_FROM_USBTOOL = usbtool.QUEUE_FROM_USBTOOL
 
@@ -73,8 +76,8 @@ try:
                     # pylint: enable=protected-access
                     # Send board data to client
                     try:
-                        data = QUEUE_FROM_USBTOOL.get_nowait()
-                        client_sock.send(data.encode("utf-8"))
+                        frame = QUEUE_FROM_USBTOOL.get_nowait()
+                        client_sock.sendall(encode_frame(frame.codes))
                     except bluetooth.btcommon.BluetoothError as err:
                         print("Connection closed:", err)
                         break
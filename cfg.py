@@ -32,6 +32,68 @@ parser.add_argument(
     action="store_false",
 )
 parser.add_argument("--epaper", help="Run software in epaper mode", action="store_true")
+parser.add_argument(
+    "--frame-transport",
+    help="How board frames are passed from the usbtool process to the main process",
+    choices=("queue", "shared_memory"),
+    default="queue",
+)
+parser.add_argument(
+    "--polling-io",
+    help=(
+        "Poll board connection every 1ms instead of waiting for I/O events "
+        "(always done on systems other than Linux)"
+    ),
+    action="store_true",
+)
+parser.add_argument(
+    "--led-interval-ms",
+    help=(
+        "Minimum time between LED messages sent to the board "
+        "(default: value measured by dev_tools/led_board_test.py or 750)"
+    ),
+    type=int,
+)
+parser.add_argument(
+    "--record", help="Record board frames and LED messages to a capture file"
+)
+parser.add_argument(
+    "--replay",
+    help="Replay a capture file (made with --record) through a pseudo-terminal",
+)
+parser.add_argument(
+    "--replay-speed",
+    help="Speed factor of --replay (0 for as fast as possible)",
+    type=float,
+    default=1.0,
+)
+parser.add_argument(
+    "--reading-filter",
+    help=(
+        "How noisy board readings are filtered: majority vote over the last 3 "
+        "frames, or per-square debounce adapted to the noise of each square"
+    ),
+    choices=("majority", "debounce"),
+    default="majority",
+)
+parser.add_argument(
+    "--nearest-codes",
+    help="Recognise piece codes with one misread byte instead of reporting unknown",
+    action="store_true",
+)
+parser.add_argument(
+    "--reading-stats",
+    help="Write board reading quality statistics to this JSON file every minute",
+)
+parser.add_argument(
+    "--move-engine",
+    help=(
+        "How moves are recognised: legal moves between the squares that differ "
+        "from the game, or an index of the placements of all legal moves"
+    ),
+    choices=("diff", "index"),
+    default="diff",
+)
 # multiprocessing extra arguments (not used by us)
 parser.add_argument("--multiprocessing-fork", nargs="*")
 
@@ -0,0 +1,336 @@
+"""
+Software Certabo board on a pseudo-terminal (Python counterpart of chess_sim.ino).
+
+It sends 320-code frames continuously, paced at the serial baud rate of the
+real board, and logs the 8-byte LED messages it receives. Piece codes come from
+a calibration file (each physical piece keeps its own code variant as it moves),
+and noise can be injected: dropped cells, wrong codes and hands hovering over
+the board.
+
+Commands are read from a script file or from stdin, one per line:
+    e2e4              move a piece (castling, en passant and promotion are
+                      applied if the move is legal, otherwise the piece is just
+                      moved from one square to the other)
+    lift e2 / place e4    remove a piece from the board and put it back
+    fen <fen>         set up a position (placement part of the FEN)
+    reset             set up the starting position
+    wait <seconds>    delay the next command (useful in scripts)
+    pause <seconds>   stop sending frames (stalled board)
+    hangup            close the pty and open a new one (unplugged board)
+
+Usage:
+    python -m dev_tools.board_simulator [--calibration FILE] [--script FILE]
+        [--link /tmp/certabo] [--drop P] [--wrong P] [--flicker P] [--baud N]
+
+then run e.g. `python main.py --usbport /tmp/certabo`. With --link the same path
+keeps working after a hangup.
+"""
+import argparse
+import logging
+import os
+import queue
+import random
+import select
+import sys
+import threading
+import time
+import tty
+
+import chess
+
+from dev_tools.framing_benchmark import PIECE_CODES
+from utils.calibration import CALIBRATION_ORDER, LEGACY_EXTENSION, CalibrationIndex
+from utils.framing import encode_frame
+
+EMPTY_CELL = bytes(5)
+FLICKER_FRAMES = 8
+
+log = logging.getLogger("board_simulator")
+
+
+def load_calibration(path):
+    """
+    Return dict piece symbol -> list of 5 byte code variants
+    """
+    if path is None:
+        return {
+            symbol: [bytes(map(int, codes.split()))]
+            for symbol, codes in PIECE_CODES.items()
+        }
+    if path.endswith(LEGACY_EXTENSION):
+        index = CalibrationIndex.load_legacy(path)
+    else:
+        with open(path, "rb") as file:
+            index = CalibrationIndex.from_bytes(file.read(), path)
+    calibration = {
+        symbol: [bytes(codes) for codes in index.piece_codes(symbol)]
+        for symbol in CALIBRATION_ORDER
+    }
+    missing = [symbol for symbol in CALIBRATION_ORDER if not calibration.get(symbol)]
+    if missing:
+        raise ValueError(f"Calibration file {path} has no codes for {missing}")
+    return calibration
+
+
+def square_to_cell(square):
+    """
+    Frames start at a8 and end at h1
+    """
+    return (7 - chess.square_rank(square)) * 8 + chess.square_file(square)
+
+
+class SimulatedBoard:
+    def __init__(self, calibration, drop=0.0, wrong=0.0, flicker=0.0):
+        self.calibration = calibration
+        self.drop = drop
+        self.wrong = wrong
+        self.flicker = flicker
+        self.flicker_cells = ()
+        self.flicker_frames = 0
+        self.board = chess.Board()
+        self.codes = {}
+        self.hand = None
+        self.reset()
+
+    def _new_codes(self, piece, placed):
+        variants = self.calibration[piece.symbol()]
+        return variants[placed.count(piece.symbol()) % len(variants)]
+
+    def set_fen(self, board_fen):
+        self.board = chess.Board(None)
+        self.board.set_board_fen(board_fen)
+        self.codes = {}
+        placed = []
+        for square, piece in sorted(self.board.piece_map().items()):
+            self.codes[square] = self._new_codes(piece, placed)
+            placed.append(piece.symbol())
+        self.hand = None
+
+    def reset(self):
+        self.set_fen(chess.STARTING_BOARD_FEN)
+
+    def move(self, uci):
+        move = chess.Move.from_uci(uci)
+        before = self.board.piece_map()
+        if move in self.board.legal_moves:
+            self.board.push(move)
+        else:
+            piece_map = dict(before)
+            piece = piece_map.pop(move.from_square, None)
+            if piece is None:
+                raise ValueError(f"No piece in {chess.square_name(move.from_square)}")
+            piece_map[move.to_square] = piece
+            turn = not self.board.turn
+            self.board.set_piece_map(piece_map)
+            self.board.turn = turn
+        after = self.board.piece_map()
+
+        # Pieces keep their codes when they move
+        old_codes = self.codes
+        vacated = [square for square in before if after.get(square) != before[square]]
+        self.codes = {
+            square: old_codes[square]
+            for square in after
+            if before.get(square) == after[square]
+        }
+        for square, piece in after.items():
+            if square in self.codes:
+                continue
+            source = next(
+                (source for source in vacated if before[source] == piece), None
+            )
+            if source is None:
+                # Promotion: a new piece is put on the board
+                self.codes[square] = self._new_codes(piece, [])
+            else:
+                vacated.remove(source)
+                self.codes[square] = old_codes[source]
+
+    def lift(self, square):
+        piece = self.board.remove_piece_at(square)
+        if piece is None:
+            raise ValueError(f"No piece in {chess.square_name(square)}")
+        self.hand = (piece, self.codes.pop(square))
+
+    def place(self, square):
+        if self.hand is None:
+            raise ValueError("No piece was lifted")
+        piece, codes = self.hand
+        self.board.set_piece_at(square, piece)
+        self.codes[square] = codes
+        self.hand = None
+
+    def frame(self):
+        """
+        Return next raw frame, with noise
+        """
+        cells = [EMPTY_CELL] * 64
+        for square, codes in self.codes.items():
+            if random.random() >= self.drop:
+                cells[square_to_cell(square)] = codes
+
+        if self.wrong:
+            for cell in range(64):
+                if random.random() < self.wrong:
+                    codes = bytearray(cells[cell])
+                    codes[random.randrange(5)] = random.randrange(256)
+                    cells[cell] = bytes(codes)
+
+        # A hand over the board hides a 3x3 area for a few frames
+        if not self.flicker_frames and random.random() < self.flicker:
+            row, col = random.randrange(8), random.randrange(8)
+            self.flicker_cells = [
+                r * 8 + c
+                for r in range(max(0, row - 1), min(8, row + 2))
+                for c in range(max(0, col - 1), min(8, col + 2))
+            ]
+            self.flicker_frames = FLICKER_FRAMES
+        if self.flicker_frames:
+            self.flicker_frames -= 1
+            for cell in self.flicker_cells:
+                cells[cell] = EMPTY_CELL
+
+        return encode_frame(b"".join(cells))
+
+
+class PtyPort:
+    """
+    Master end of a pseudo-terminal, optionally reachable through a symlink
+    """
+
+    def __init__(self, link=None):
+        self.link = link
+        self.master = self.slave = None
+        self.open()
+
+    def open(self):
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.master)
+        name = os.ttyname(self.slave)
+        if self.link is not None:
+            if os.path.lexists(self.link):
+                os.remove(self.link)
+            os.symlink(name, self.link)
+            name = f"{self.link} -> {name}"
+        log.info(f"Board simulator listening on {name}")
+
+    def hangup(self):
+        os.close(self.master)
+        os.close(self.slave)
+        self.open()
+
+    def write(self, data):
+        os.write(self.master, data)
+
+    def read_leds(self):
+        readable, _, _ = select.select([self.master], [], [], 0)
+        if not readable:
+            return b""
+        try:
+            return os.read(self.master, 4096)
+        except OSError:
+            return b""
+
+
+def leds_to_squares(leds):
+    return [
+        f"{chess.FILE_NAMES[file]}{8 - row}"
+        for row, byte in enumerate(leds)
+        for file in range(8)
+        if byte & (1 << file)
+    ]
+
+
+def read_commands(lines, commands):
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        if line.startswith("wait "):
+            time.sleep(float(line.split()[1]))
+        else:
+            commands.put(line)
+
+
+def run_command(command, board, port):
+    """
+    Apply a command, return number of seconds frames should be paused for
+    """
+    name, *args = command.split(maxsplit=1)
+    if name == "reset":
+        board.reset()
+    elif name == "fen":
+        board.set_fen(args[0].split()[0])
+    elif name == "lift":
+        board.lift(chess.parse_square(args[0]))
+    elif name == "place":
+        board.place(chess.parse_square(args[0]))
+    elif name == "pause":
+        return float(args[0])
+    elif name == "hangup":
+        port.hangup()
+    else:
+        board.move(name)
+    log.info(f"{command}: {board.board.board_fen()}")
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--calibration", help="calibration-*.cal (or old .bin) file")
+    parser.add_argument("--script", help="File with commands (default: stdin)")
+    parser.add_argument("--link", help="Symlink pointing to the current pty")
+    parser.add_argument("--baud", type=int, default=38400, help="0 for no pacing")
+    parser.add_argument("--drop", type=float, default=0.0, help="P(cell not read)")
+    parser.add_argument("--wrong", type=float, default=0.0, help="P(cell garbled)")
+    parser.add_argument("--flicker", type=float, default=0.0, help="P(hand/frame)")
+    parser.add_argument("--seed", type=int)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s: %(message)s")
+    random.seed(args.seed)
+    board = SimulatedBoard(
+        load_calibration(args.calibration), args.drop, args.wrong, args.flicker
+    )
+    port = PtyPort(args.link)
+
+    commands = queue.Queue()
+    if args.script:
+        with open(args.script, "r", encoding="utf-8") as file:
+            lines = file.readlines()
+    else:
+        lines = sys.stdin
+    threading.Thread(target=read_commands, args=(lines, commands), daemon=True).start()
+
+    leds = b""
+    try:
+        while True:
+            pause = 0
+            while not commands.empty():
+                command = commands.get_nowait()
+                try:
+                    pause += run_command(command, board, port)
+                except ValueError as exc:
+                    log.warning(f"Invalid command {command!r}: {exc}")
+            if pause:
+                time.sleep(pause)
+
+            frame = board.frame()
+            port.write(frame)
+            if args.baud:
+                # 8 data bits + start and stop bits per byte
+                time.sleep(len(frame) * 10 / args.baud)
+
+            leds += port.read_leds()
+            while len(leds) >= 8:
+                log.info(f"LEDs: {leds_to_squares(leds[:8])}")
+                leds = leds[8:]
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if args.link is not None and os.path.lexists(args.link):
+            os.remove(args.link)
+
+
+if __name__ == "__main__":
+    main()
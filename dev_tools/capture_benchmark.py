@@ -0,0 +1,67 @@
+"""
+Deterministic benchmark of the reading pipeline on a recorded board session.
+
+The frames of a capture (made with --record) are filtered as usbtool would do
+it and fed to BoardReader as fast as possible. Every physical position change is
+then matched against the game with get_moves, like the main loop does while
+waiting for a move. No board is needed, so it can run anywhere.
+
+The calibration of the board used for the recording is needed to make sense of
+the codes: it is looked up by port name, as in main.py (--usbport).
+
+Usage: python -m dev_tools.capture_benchmark --replay capture.bin [--usbport PORT]
+"""
+import queue
+import time
+
+import chess
+
+import cfg
+from utils import capture, reader_writer, usbtool
+from utils.get_moves import get_moves
+
+
+def main():
+    replayed_frames = queue.Queue()
+    n_frames = capture.replay_to_queue(cfg.args.replay, replayed_frames)
+    frames = [replayed_frames.get_nowait() for _ in range(n_frames)]
+
+    usbtool.QUEUE_FROM_USBTOOL = queue.Queue()
+    board_reader = reader_writer.BoardReader(cfg.args.usbport or "replay")
+    if board_reader.needs_calibration:
+        print(f"Warning: no calibration found in {board_reader.calibration_filepath}")
+
+    # One update per frame, as if the main loop was always faster than the board
+    fens = []
+    start = time.perf_counter()
+    for frame in frames:
+        board_reader.queue.put_nowait(frame)
+        fen = board_reader.read_board()
+        if not fens or fen != fens[-1]:
+            fens.append(fen)
+    reader_time = time.perf_counter() - start
+
+    board = chess.Board()
+    moves = []
+    start = time.perf_counter()
+    for fen in fens:
+        new_moves = get_moves(board, fen)
+        for move in new_moves:
+            board.push_uci(move)
+        moves.extend(new_moves)
+    moves_time = time.perf_counter() - start
+
+    print(f"{n_frames} frames forwarded, {len(fens)} distinct positions")
+    print(
+        f"BoardReader: {reader_time * 1000:.1f}ms total, "
+        f"{reader_time / max(n_frames, 1) * 1e6:.1f}us per frame"
+    )
+    print(
+        f"get_moves: {moves_time * 1000:.1f}ms total, "
+        f"{moves_time / max(len(fens), 1) * 1e6:.1f}us per position"
+    )
+    print(f"Moves detected: {' '.join(moves)}")
+
+
+if __name__ == "__main__":
+    main()
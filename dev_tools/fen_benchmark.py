@@ -0,0 +1,207 @@
+"""
+Benchmark of BoardReader.data_to_fen: legacy per-square Counter vote over the
+sliced 5-byte cell codes vs packed cell keys with memoised votes and FEN rows,
+voting all cells ("full") or only those read differently ("update").
+
+Random frame histories (noisy, with unknown codes, ties and empty history slots)
+are checked to give identical board_fen and board_fen_missing with both
+versions. A simulated game (a few squares change per frame) is then fed through
+BoardReader.update, which only votes again the cells read differently, and
+compared frame by frame with the legacy version, including the changed squares
+it reports. Both are timed for one new frame per update, as in the main loop.
+
+Usage: python -m dev_tools.fen_benchmark
+"""
+import random
+import tempfile
+import time
+from collections import Counter
+from queue import Queue
+
+import chess
+
+from dev_tools.framing_benchmark import PIECE_CODES, START_BOARD
+from utils import calibration, logger, reader_writer
+from utils.framing import BoardFrame
+
+PIECE_CELLS = {
+    piece: bytes(map(int, codes.split())) for piece, codes in PIECE_CODES.items()
+}
+EMPTY_CELL = bytes(5)
+N_FRAMES = 2000
+
+
+def make_codes(board=START_BOARD, noise=0.0):
+    cells = []
+    for piece in board:
+        cell = EMPTY_CELL if piece == "." else PIECE_CELLS[piece]
+        if random.random() < noise:
+            # Hidden or misread cell
+            cell = random.choice(
+                (EMPTY_CELL, bytes(random.randrange(256) for _ in range(5)))
+            )
+        cells.append(cell)
+    return b"".join(cells)
+
+
+def legacy_data_to_fen(data_history, code_mapping, depth):
+    """
+    BoardReader.data_to_fen before packed cell keys (code_mapping has bytes keys)
+    """
+    counter = Counter()
+    data_history = [data for data in data_history if data]
+    board = []
+    for cell in range(64):
+        cell_range = slice(cell * 5, cell * 5 + 5)
+        sample = (code_mapping.get(sample[cell_range], "?") for sample in data_history)
+        counter.update(sample)
+        most_common_code, most_common_counts = counter.most_common(1)[0]
+        if most_common_code == "?" and most_common_counts < depth:
+            most_common_code = "."
+        board.append(most_common_code)
+        counter.clear()
+
+    def board_to_fen(board, ignore_unknown):
+        fen_string = ""
+        for row in range(8):
+            empty = 0
+            for col in range(8):
+                piece = board[row * 8 + col]
+                if piece == "." or (ignore_unknown and piece == "?"):
+                    empty += 1
+                else:
+                    if empty > 0:
+                        fen_string += str(empty)
+                        empty = 0
+                    fen_string += piece
+            if empty > 0:
+                fen_string += str(empty)
+            if row < 7:
+                fen_string += r"/"
+        return fen_string
+
+    fen_string = board_to_fen(board, ignore_unknown=True)
+    return fen_string, board_to_fen(board, ignore_unknown=False)
+
+
+def make_board_reader():
+    # Keep the benchmark calibration away from the real ones
+    logger.CERTABO_DATA_PATH = tempfile.mkdtemp()
+    calibration.CalibrationIndex(
+        [[PIECE_CELLS[piece]] for piece in calibration.CALIBRATION_ORDER]
+    ).save(calibration.calibration_filepath("benchmark"))
+    return reader_writer.BoardReader("benchmark")
+
+
+def set_history_slot(board_reader, slot, data):
+    board_reader.data_history[slot] = data
+    board_reader.pieces_history[slot] = (
+        board_reader.frame_to_pieces(data) if data else None
+    )
+
+
+def make_game_frames(n_frames):
+    """
+    Noisy frames of a game where pieces are lifted and put down
+    """
+    board = list(START_BOARD)
+    frames = []
+    for _ in range(n_frames):
+        if random.random() < 0.2:
+            source, target = random.randrange(64), random.randrange(64)
+            board[target], board[source] = board[source], "."
+        frames.append(make_codes("".join(board), noise=0.02))
+    return frames
+
+
+def main(n_frames=N_FRAMES):
+    random.seed(0)
+    board_reader = make_board_reader()
+    depth = board_reader.data_history_depth
+    legacy_mapping = {
+        code.to_bytes(5, "big"): piece
+        for code, piece in board_reader.code_mapping.items()
+    }
+
+    # Equivalence on random histories
+    boards = [START_BOARD, "." * 64, "rnbqkbnr" + "." * 48 + "RNBQKBNR"]
+    for _ in range(n_frames):
+        board = "".join(
+            random.choice(".pP") if random.random() < 0.1 else piece
+            for piece in random.choice(boards)
+        )
+        for slot in range(depth):
+            data = (
+                b""
+                if random.random() < 0.1
+                else make_codes(board, noise=random.choice((0.0, 0.1, 0.5)))
+            )
+            set_history_slot(board_reader, slot, data)
+        if not any(board_reader.data_history):
+            # data_to_fen is only called once a frame was received
+            continue
+        board_reader.data_to_fen()
+        expected = legacy_data_to_fen(board_reader.data_history, legacy_mapping, depth)
+        assert (
+            board_reader.board_fen,
+            board_reader.board_fen_missing,
+        ) == expected, "Versions disagree!"
+    print(f"Checked {n_frames} random histories: identical FENs")
+
+    # Incremental updates along a game
+    frames = make_game_frames(n_frames)
+    board_reader = make_board_reader()
+    board_reader.queue = Queue()
+    for data in frames:
+        previous = list(board_reader.board)
+        board_reader.queue.put(BoardFrame(data, random.choice((1, 1, 2))))
+        changed_squares = board_reader.update()
+        expected = legacy_data_to_fen(board_reader.data_history, legacy_mapping, depth)
+        assert (
+            board_reader.board_fen,
+            board_reader.board_fen_missing,
+        ) == expected, "Incremental update disagrees!"
+        expected_squares = [
+            square
+            for square, cell in zip(chess.SQUARES, chess.SQUARES_180)
+            if previous[cell] != board_reader.board[cell]
+        ]
+        assert changed_squares == expected_squares, "Wrong changed squares!"
+    print(f"Checked {n_frames} incremental updates: identical FENs")
+
+    # Timing: one new (noisy) frame per update
+    history = [b""] * depth
+    start = time.perf_counter()
+    for n, data in enumerate(frames):
+        history[n % depth] = data
+        legacy_data_to_fen(history, legacy_mapping, depth)
+    legacy_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for n, data in enumerate(frames):
+        set_history_slot(board_reader, n % depth, data)
+        board_reader.data_to_fen()
+    full_time = time.perf_counter() - start
+
+    board_reader = make_board_reader()
+    board_reader.queue = Queue()
+    start = time.perf_counter()
+    for data in frames:
+        board_reader.queue.put(BoardFrame(data, 1))
+        board_reader.update()
+    incremental_time = time.perf_counter() - start
+
+    for name, elapsed in (
+        ("legacy", legacy_time),
+        ("full", full_time),
+        ("update", incremental_time),
+    ):
+        print(
+            f"{name:>8}: {elapsed * 1000:8.1f}ms total, "
+            f"{elapsed / n_frames * 1e6:8.1f}us per frame "
+            f"({legacy_time / elapsed:.1f}x)"
+        )
+
+
+if __name__ == "__main__":
+    main()
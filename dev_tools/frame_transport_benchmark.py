@@ -0,0 +1,117 @@
+"""
+Benchmark of the transports between the usbtool process and the main process:
+multiprocessing.Queue vs shared memory frame ring.
+
+A writer process plays the role of usbtool and sends decoded frames, while the
+main process consumes them through BoardReader, as in main.py. Two measurements
+are taken for each transport:
+    - throughput: writer sends frames as fast as possible. Frames delivered to
+      BoardReader are counted per second. The shared memory ring only delivers
+      the most recent frames of each update, so the frames it skipped (whose
+      readings are accounted for in the next frame) are reported separately.
+    - latency: writer sends a frame every 250ms (the board sends one every
+      210-340ms at 38400 baud) and the time from put to FEN computed in
+      BoardReader.update is recorded
+
+Usage: python -m dev_tools.frame_transport_benchmark
+"""
+import multiprocessing
+import struct
+import time
+
+from dev_tools.framing_benchmark import make_frame
+from utils import reader_writer, usbtool
+from utils.framing import BoardFrame, decode_frame
+from utils.shared_frames import SharedFrameRing
+
+N_FRAMES = 2000
+N_LATENCY_FRAMES = 40
+LATENCY_INTERVAL = 0.250
+BASE_FRAME = decode_frame(make_frame())
+
+
+def numbered_frame(i):
+    # Frame number is stored in the codes of cell a8
+    return BoardFrame(struct.pack("I", i) + BASE_FRAME[4:], 1)
+
+
+def frame_number(frame):
+    return struct.unpack_from("I", frame.codes)[0]
+
+
+def writer(frames_queue, n_frames, interval, send_times):
+    for i in range(n_frames):
+        send_times[i] = time.monotonic()
+        frames_queue.put(numbered_frame(i))
+        if interval:
+            time.sleep(interval)
+
+
+class TimedBoardReader(reader_writer.BoardReader):
+    def __init__(self, portname):
+        super().__init__(portname)
+        self.received = []
+
+    def get_new_frames(self):
+        frames = super().get_new_frames()
+        self.received.extend(frames)
+        return frames
+
+
+def run(transport, n_frames, interval):
+    if transport == "shared_memory":
+        frames_queue = SharedFrameRing()
+    else:
+        frames_queue = multiprocessing.Queue(maxsize=64)
+    usbtool.QUEUE_FROM_USBTOOL = frames_queue
+    board_reader = TimedBoardReader("benchmark")
+
+    send_times = multiprocessing.Array("d", n_frames, lock=False)
+    process = multiprocessing.Process(
+        target=writer, args=(frames_queue, n_frames, interval, send_times)
+    )
+    start = time.perf_counter()
+    process.start()
+
+    latencies = []
+    skipped = 0
+    last_number = -1
+    while last_number < n_frames - 1:
+        board_reader.update()
+        now = time.monotonic()
+        for frame in board_reader.received:
+            last_number = frame_number(frame)
+            latencies.append(now - send_times[last_number])
+            skipped += frame.skipped
+        board_reader.received.clear()
+        if interval:
+            time.sleep(0.001)
+
+    elapsed = time.perf_counter() - start
+    process.join()
+    if transport == "shared_memory":
+        frames_queue.close()
+    return elapsed, latencies, skipped
+
+
+def main():
+    for transport in ("queue", "shared_memory"):
+        elapsed, latencies, skipped = run(transport, N_FRAMES, 0)
+        print(
+            f"{transport:>13} throughput: {N_FRAMES / elapsed:8.0f} frames/s sent, "
+            f"{len(latencies) / elapsed:8.0f} frames/s delivered "
+            f"({len(latencies)} of {N_FRAMES} delivered, {skipped} skipped)"
+        )
+
+        _, latencies, _ = run(transport, N_LATENCY_FRAMES, LATENCY_INTERVAL)
+        latencies = sorted(latency * 1000 for latency in latencies)
+        print(
+            f"{transport:>13} latency to FEN: "
+            f"median {latencies[len(latencies) // 2]:.2f}ms, "
+            f"p95 {latencies[int(len(latencies) * 0.95)]:.2f}ms, "
+            f"max {latencies[-1]:.2f}ms"
+        )
+
+
+if __name__ == "__main__":
+    main()
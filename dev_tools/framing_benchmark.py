@@ -0,0 +1,119 @@
+"""
+Benchmark of the usbtool serial framing: legacy per-byte reading and string
+frames vs FrameBuffer with decoding to 320 byte frames.
+
+Board frames are fed through a fake serial device that hands data out in USB
+sized chunks, the same way pyserial would on a real board.
+
+Usage: python -m dev_tools.framing_benchmark [n_frames]
+"""
+import random
+import sys
+import time
+
+from utils.framing import FrameBuffer, decode_frame
+
+# Codes taken from dev_tools/chess_sim.ino
+PIECE_CODES = {
+    "r": "101 2 3 4 5",
+    "n": "201 2 32 4 57",
+    "b": "202 27 32 4 57",
+    "q": "202 27 32 41 57",
+    "k": "208 0 245 1 84",
+    "p": "211 0 132 63 192",
+    "R": "3 0 115 87 237",
+    "N": "3 0 115 41 35",
+    "B": "3 0 116 59 170",
+    "Q": "3 0 116 74 26",
+    "K": "3 0 116 84 26",
+    "P": "11 0 132 63 192",
+}
+START_BOARD = "rnbqkbnrpppppppp" + "." * 32 + "PPPPPPPPRNBQKBNR"
+
+
+def make_frame(board=START_BOARD, noise=0.0):
+    cells = []
+    for piece in board:
+        if piece == "." or random.random() < noise:
+            cells.append("0 0 0 0 0")
+        else:
+            cells.append(PIECE_CODES[piece])
+    return (":" + " ".join(cells) + " \r\n").encode("ascii")
+
+
+class FakeSerial:
+    """
+    Minimal pyserial stand-in that serves a byte stream in fixed size chunks
+    """
+
+    def __init__(self, stream, chunk_size=64):
+        self.stream = stream
+        self.position = 0
+        self.chunk_size = chunk_size
+
+    @property
+    def in_waiting(self):
+        return min(self.chunk_size, len(self.stream) - self.position)
+
+    def inWaiting(self):  # pylint: disable=invalid-name
+        return self.in_waiting
+
+    def read(self, size=1):
+        data = self.stream[self.position : self.position + size]
+        self.position += len(data)
+        return data
+
+    def reset_input_buffer(self):
+        pass
+
+
+def legacy_path(device):
+    frames = []
+    message_from_board = ""
+    while device.inWaiting():
+        char = device.read().decode("ISO-8859-1")
+        if char != "\n":
+            message_from_board += char
+        else:
+            message_from_board = message_from_board[:-2]
+            if len(message_from_board.split(" ")) == 320:
+                frames.append(message_from_board)
+            message_from_board = ""
+    return frames
+
+
+def frame_buffer_path(device):
+    frames = []
+    frame_buffer = FrameBuffer()
+    while frame_buffer.read_from(device):
+        for line in frame_buffer.pop_frames():
+            codes = decode_frame(line)
+            if codes is not None:
+                frames.append(codes)
+    return frames
+
+
+def main(n_frames=500):
+    random.seed(0)
+    stream = b"".join(make_frame(noise=0.05) for _ in range(n_frames))
+    print(f"Feeding {n_frames} frames ({len(stream) / 1024:.0f} KB)")
+
+    results = {}
+    for name, path in (("legacy", legacy_path), ("frame_buffer", frame_buffer_path)):
+        start = time.perf_counter()
+        frames = path(FakeSerial(stream))
+        elapsed = time.perf_counter() - start
+        results[name] = frames
+        print(
+            f"{name:>14}: {elapsed * 1000:8.1f}ms total, "
+            f"{elapsed / n_frames * 1e6:8.1f}us per frame"
+        )
+
+    legacy_codes = [
+        bytes(map(int, frame[1:].split(" "))) for frame in results["legacy"]
+    ]
+    assert legacy_codes == results["frame_buffer"], "Paths disagree!"
+
+
+if __name__ == "__main__":
+    main(*(int(arg) for arg in sys.argv[1:]))
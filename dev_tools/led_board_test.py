@@ -1,56 +1,100 @@
-import logging
+"""
+Finds the minimum interval between LED messages that the connected board
+handles reliably, and saves it (with a safety margin) for usbtool to use.
+
+Boards with some firmware versions ignore an LED message that arrives too
+shortly after the previous one. For each candidate interval, the center squares
+are lit and, after that interval, replaced by a random corner square. The user
+types the square that ended up lit, which tells whether the second message was
+applied. Candidates are bisected between MIN_MS and MAX_MS.
+
+Usage: python -m dev_tools.led_board_test [--usbport PORT]
+"""
+import math
+import random
 import time
 
-from utils import reader_writer
-
-assert reader_writer.DEBUG_LED, 'DEBUG_LED is set to FALSE!'
-
-port = utils.usbtool.find_address()
-utils.usbtool(port, buffer_ms=0)
-led_manager = reader_writer.LedWriter()
-
-ranges_ms = (10, 50, 100, 150, 200, 250, 500, 750, 1000)
-logging.info(f'Testing gaps of {ranges_ms} ms')
-
-print(f'Testing gaps of {ranges_ms} ms')
-print('')
-print('Answer 0 for failures and 1 for successes.')
-print('Press 5 to skip to next time gap during test (if needed).')
-print('Press Enter to confirm response')
-
-for i, gap_ms in enumerate(ranges_ms, 1):
-    logging.info(f'Testing gap of {gap_ms}ms')
-    print('')
-    print(f'>>> Testing gap of {gap_ms}ms')
-
-    gap_s = gap_ms / 1000
-    for j in range(10):
-        logging.info(f'{j}/10')
-
-        led_manager.set_leds('thinking')
-        time.sleep(gap_s)
-        led_manager.set_leds('e2e4')
-        time.sleep(.5)
-
-        skip = False
-        while True:
-            try:
-                success = int(input(f'({j}/10) Did leds e2e4 light up?'))
-                assert success in (0, 1, 5), "Invalid Number"
-            except Exception as e:
-                print(e)
-                print('Answer with 0 or 1 (or 5 to skip range).')
-            else:
-                if success == 5:
-                    logging.info('Skipping this range')
-                    print('Skipping this range')
-                    skip = True
-                else:
-                    logging.info(f'Answer: {success}')
-                break
+import cfg
+from utils import led_scheduler, logger, reader_writer, usbtool
+
+MIN_MS = 0
+MAX_MS = 1000
+RESOLUTION_MS = 10
+TRIALS = 5
+SAFETY_MARGIN = 1.25
+TARGET_SQUARES = ("a1", "a8", "h1", "h8")
+
+cfg.APPLICATION = "led_board_test"
+cfg.DEBUG = True
+cfg.DEBUG_LED = True
+logger.set_logger()
+log = logger.get_logger()
+
+
+def ask_lit_square():
+    while True:
+        answer = input("Which corner square is lit? (Enter if none) ").strip().lower()
+        if answer in TARGET_SQUARES or not answer:
+            return answer
+        print(f"Answer one of {TARGET_SQUARES} or press Enter")
+
+
+def interval_works(led_manager, gap_ms):
+    log.info(f">>> Testing interval of {gap_ms}ms")
+    for trial in range(1, TRIALS + 1):
+        target = random.choice(TARGET_SQUARES)
+        led_manager.set_leds("center")
+        time.sleep(gap_ms / 1000)
+        led_manager.set_leds(target)
+        time.sleep(0.5)
+
+        answer = ask_lit_square()
+        log.debug(f"({trial}/{TRIALS}) target={target}, answer={answer}")
 
         led_manager.set_leds()
-        time.sleep(1.5)
+        time.sleep(MAX_MS / 1000 + 0.5)
+        if answer != target:
+            log.info(f"Interval of {gap_ms}ms failed")
+            return False
+    log.info(f"Interval of {gap_ms}ms works")
+    return True
+
+
+def main():
+    port_chessboard = cfg.args.usbport
+    while port_chessboard is None:
+        port_chessboard = usbtool.find_address()
+        if port_chessboard is None:
+            print("Did not find serial port, make sure Certabo board is connected")
+            time.sleep(1)
+
+    # Let every LED message through, the test itself spaces them
+    usbtool.start_usbtool(port_chessboard, led_interval_ms=0)
+    led_manager = reader_writer.LedWriter()
+    time.sleep(1)
+
+    if not interval_works(led_manager, MAX_MS):
+        log.info(f"Board did not handle LED messages even {MAX_MS}ms apart, giving up")
+        return
+
+    low, high = MIN_MS, MAX_MS
+    while high - low > RESOLUTION_MS:
+        gap_ms = (low + high) // 2
+        if interval_works(led_manager, gap_ms):
+            high = gap_ms
+        else:
+            low = gap_ms
+
+    interval_ms = math.ceil(high * SAFETY_MARGIN / RESOLUTION_MS) * RESOLUTION_MS
+    log.info(
+        f"Shortest reliable interval: {high}ms, "
+        f"with safety margin: {interval_ms}ms "
+        f"(currently used: {led_scheduler.load_min_interval_ms()}ms)"
+    )
+    if input("Save it for this computer? [y/N] ").strip().lower() == "y":
+        led_scheduler.save_min_interval_ms(interval_ms)
+        log.info(f"Saved to {led_scheduler.CERTABO_SETTINGS_FILEPATH}")
+
 
-        if skip:
-            break
+if __name__ == "__main__":
+    main()
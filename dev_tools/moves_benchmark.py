@@ -0,0 +1,207 @@
+"""
+Benchmark of utils.get_moves.get_moves: legacy brute force (push every legal
+move, and every reply for double moves, comparing board FENs) vs the engines
+of get_moves: per position MoveIndex ("index") and occupancy diff ("diff").
+
+Random games are played, and for each ply the physical board goes through the
+placements a human player produces: the piece to move lifted (no match), the
+move played, and in human games both sides' moves (double move). All versions
+are checked to return the same moves, then timed over the same frames as the
+main loop would look them up, each new position starting with an empty cache.
+The diff engine is also checked against the index for every placement one or
+two moves away. Finally, get_moves.catch_up_moves is timed on boards a few
+random moves ahead of the game.
+
+Usage: python -m dev_tools.moves_benchmark
+"""
+import random
+import time
+
+import chess
+from lru import LRU
+
+from utils import get_moves
+
+N_GAMES = 2
+MAX_PLIES = 40
+N_CATCH_UPS = 50
+MAX_CATCH_UP_CALLS = 100
+
+
+def legacy_get_moves(virtual_board, physical_fen, check_double_moves=False):
+    """
+    get_moves before the move index
+    """
+    virtual_fen = virtual_board.board_fen()
+    caching_key = (virtual_fen, physical_fen, check_double_moves)
+    try:
+        return legacy_get_moves.cache[caching_key]
+    except KeyError:
+        pass
+
+    copy_board = virtual_board.copy()
+    moves = list(virtual_board.generate_legal_moves())
+    for move in moves:
+        copy_board.push(move)
+        if physical_fen == copy_board.board_fen():
+            result = [move.uci()]
+            legacy_get_moves.cache[caching_key] = result
+            return result
+        copy_board.pop()
+
+    if check_double_moves:
+        for move in moves:
+            copy_board.push(move)
+            legal_moves2 = list(copy_board.generate_legal_moves())
+            for move2 in legal_moves2:
+                copy_board.push(move2)
+                if physical_fen == copy_board.board_fen():
+                    result = [move.uci(), move2.uci()]
+                    legacy_get_moves.cache[caching_key] = result
+                    return result
+                copy_board.pop()
+            copy_board.pop()
+
+    result = []
+    legacy_get_moves.cache[caching_key] = result
+    return result
+
+
+legacy_get_moves.cache = LRU(8)
+
+
+def lifted_fen(board, move):
+    lifted = chess.BaseBoard(board.board_fen())
+    lifted.remove_piece_at(move.from_square)
+    return lifted.board_fen()
+
+
+def make_lookups(n_games=N_GAMES, max_plies=MAX_PLIES):
+    """
+    Return list of (virtual board, physical FENs looked up in that position)
+    """
+    lookups = []
+    for _ in range(n_games):
+        board = chess.Board()
+        for _ in range(max_plies):
+            moves = list(board.legal_moves)
+            if not moves:
+                break
+            move = random.choice(moves)
+            fens = [lifted_fen(board, move)] * 3
+            board.push(move)
+            fens += [board.board_fen()] * 3
+            replies = list(board.legal_moves)
+            if replies:
+                reply = random.choice(replies)
+                fens.append(lifted_fen(board, reply))
+                board.push(reply)
+                fens.append(board.board_fen())
+                board.pop()
+            board.pop()
+            lookups.append((board.copy(), fens))
+            board.push(move)
+    return lookups
+
+
+ENGINES = {
+    "legacy": (legacy_get_moves, legacy_get_moves.cache.clear),
+    "index": (get_moves.index_moves, get_moves.move_index_cache.clear),
+    "diff": (get_moves.diff_moves, get_moves.diff_moves_cache.clear),
+}
+
+
+def check_all_placements(board):
+    """
+    Check diff engine finds the moves of the index for every placement it has
+    """
+    move_index = get_moves.get_move_index(board)
+    move_index.build_double_moves()
+    for moves in (move_index.single_moves, move_index.double_moves):
+        for key in moves:
+            expected = move_index.get(key, True)
+            assert (
+                get_moves.find_diff_moves(board, key, True) == expected
+            ), f"{board.fen()}: {expected}"
+
+
+def check_catch_up(lookups, n_catch_ups=N_CATCH_UPS):
+    """
+    Time catch_up_moves (until its search is finished) from random positions to
+    boards 3 to 6 random moves ahead, and check the moves found lead to those
+    boards
+    """
+    found = 0
+    times = []
+    for _ in range(n_catch_ups):
+        virtual_board = random.choice(lookups)[0]
+        board = virtual_board.copy()
+        for _ in range(random.randint(3, 6)):
+            moves = list(board.legal_moves)
+            if not moves:
+                break
+            board.push(random.choice(moves))
+        # Called again while the search is unfinished, as the main loop does
+        start = time.perf_counter()
+        for _ in range(MAX_CATCH_UP_CALLS):
+            moves = get_moves.catch_up_moves(virtual_board, board.board_fen())
+            if not get_moves.catch_up_searches:
+                break
+        times.append(time.perf_counter() - start)
+        if moves:
+            found += 1
+            result = virtual_board.copy()
+            for move in moves:
+                result.push_uci(move)
+            assert result.board_fen() == board.board_fen(), "Wrong catch up!"
+    times.sort()
+    print(
+        f"catch_up_moves: found {found} of {n_catch_ups}, "
+        f"median {times[len(times) // 2] * 1000:.1f}ms, max {times[-1] * 1000:.1f}ms"
+    )
+
+
+def time_lookups(function, lookups, check_double_moves, clear_cache):
+    start = time.perf_counter()
+    for board, fens in lookups:
+        clear_cache()
+        for fen in fens:
+            function(board, fen, check_double_moves)
+    return time.perf_counter() - start
+
+
+def main():
+    random.seed(0)
+    lookups = make_lookups()
+    n_fens = sum(len(fens) for _, fens in lookups)
+
+    for board, fens in lookups:
+        for check_double_moves in (False, True):
+            for fen in fens:
+                expected = legacy_get_moves(board, fen, check_double_moves)
+                for name, (function, _) in ENGINES.items():
+                    result = function(board, fen, check_double_moves)
+                    assert result == expected, f"{name} {board.fen()} {fen}: {result}"
+    print(f"Checked {n_fens} lookups in {len(lookups)} positions: identical moves")
+    for board, _ in lookups[::4]:
+        check_all_placements(board)
+    print(f"Checked all placements of {len(lookups[::4])} positions: identical moves")
+
+    for check_double_moves in (False, True):
+        times = {
+            name: time_lookups(function, lookups, check_double_moves, clear_cache)
+            for name, (function, clear_cache) in ENGINES.items()
+        }
+        print(f"check_double_moves={check_double_moves}:")
+        for name, elapsed in times.items():
+            print(
+                f"{name:>8}: {elapsed * 1000:8.1f}ms total, "
+                f"{elapsed / n_fens * 1e6:8.1f}us per lookup "
+                f"({times['legacy'] / elapsed:.1f}x)"
+            )
+
+    check_catch_up(lookups)
+
+
+if __name__ == "__main__":
+    main()
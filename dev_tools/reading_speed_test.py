@@ -1,34 +1,91 @@
+"""
+Compares the reading filters of BoardReader (--reading-filter) on the same
+board frames: time to detect a piece being placed, and number of false changes
+(positions shown other than the two expected ones).
+
+Usage: python -m dev_tools.reading_speed_test [--usbport PORT]
+(works with dev_tools/board_simulator.py too, e.g. with --wrong and --flicker)
+"""
 import logging
+import queue
 import time
 
 import cfg
 from utils import reader_writer, usbtool, logger
 
 NTRIALS = 10
+FILTERS = ('majority', 'debounce')
+BASE_FEN = '8/8/8/2ppp3/2p1p3/2ppp3/8/8'
+TARGET_FEN = '8/8/8/2ppp3/2pPp3/2ppp3/8/8'
 cfg.APPLICATION = 'reading_speed_test'
 cfg.VERSION = '09.07.2020'
 cfg.DEBUG = True
 cfg.DEBUG_READING = True
 
-while True:
+port_chessboard = cfg.args.usbport
+while port_chessboard is None:
     port_chessboard = usbtool.find_address()
-    if port_chessboard is not None:
-        break
-    else:
+    if port_chessboard is None:
         print('Did not find serial port, make sure Certabo board is connected')
         time.sleep(.1)
 
 logger.set_logger()
 usbtool.start_usbtool(port_chessboard)
-usb_reader = reader_writer.BoardReader(port_chessboard)
 led_manager = reader_writer.LedWriter()
 
+# Every reader gets its own copy of the frames received
+readers = {}
+for name in FILTERS:
+    readers[name] = reader_writer.BoardReader(port_chessboard, reading_filter=name)
+    readers[name].queue = queue.Queue()
+times = {name: [] for name in FILTERS}
+changes = {name: 0 for name in FILTERS}
+false_changes = {name: 0 for name in FILTERS}
+n_reads = 0
+counting = False
+
 
 def msg(message):
     logging.info(message)
     print(message)
 
 
+def read_boards():
+    global n_reads
+    frames = []
+    while True:
+        try:
+            frames.append(usbtool.QUEUE_FROM_USBTOOL.get_nowait())
+        except queue.Empty:
+            break
+    if counting:
+        n_reads += sum(frame.repeats for frame in frames)
+
+    fens = {}
+    for name, reader in readers.items():
+        for frame in frames:
+            reader.queue.put(frame)
+        if reader.update() and counting:
+            changes[name] += 1
+            if reader.board_fen not in (BASE_FEN, TARGET_FEN):
+                false_changes[name] += 1
+                msg(f'{name}: false change to {reader.board_fen_missing}')
+        fens[name] = reader.board_fen
+    return fens
+
+
+def read_for(seconds):
+    end_time = time.time() + seconds
+    while time.time() < end_time:
+        read_boards()
+        time.sleep(.01)
+
+
+def wait_for(fen):
+    while any(board_fen != fen for board_fen in read_boards().values()):
+        time.sleep(.01)
+
+
 border_leds = [
     'c5', 'd5', 'e5',
     'c4',       'e4',
@@ -37,38 +94,44 @@ border_leds = [
 
 msg('Place black pawns around d4 square and remove any other pieces from the board')
 led_manager.set_leds(border_leds)
+wait_for(BASE_FEN)
+counting = True
 
-while usb_reader.read_board() != '8/8/8/2ppp3/2p1p3/2ppp3/8/8':
-    time.sleep(1)
-
-times = []
-for i in range(10):
+for i in range(NTRIALS):
     msg(f'Trial {i}')
 
     led_manager.set_leds(border_leds)
-    while usb_reader.read_board() != '8/8/8/2ppp3/2p1p3/2ppp3/8/8':
-        time.sleep(.01)
-    time.sleep(2)
+    wait_for(BASE_FEN)
+    read_for(2)
 
     msg('Place white pawn on D4 when the square LED turns on')
-    time.sleep(.500)
+    read_for(.500)
     led_manager.set_leds()
-    time.sleep(.500)
+    read_for(.500)
     led_manager.set_leds('d4')
-    time.sleep(.750)  # Time that it takes to send command
+    read_for(.750)  # Time that it takes to send command
 
     start_time = time.time()
-    while usb_reader.read_board() != '8/8/8/2ppp3/2pPp3/2ppp3/8/8':
+    waiting = set(FILTERS)
+    while waiting:
+        fens = read_boards()
+        for name in list(waiting):
+            if fens[name] == TARGET_FEN:
+                diff_time = (time.time() - start_time) * 1000
+                times[name].append(diff_time)
+                waiting.remove(name)
+                msg(f'{name}: change detected in {diff_time:.0f}ms')
         time.sleep(.001)
-    print('here')
-    end_time = time.time()
-    diff_time = (end_time - start_time) * 1000
-    times.append(diff_time)
-    msg(f'Change detected in {diff_time:.0f}ms')
-    print('Remove white pawn from D4')
+    msg('Remove white pawn from D4')
 
 led_manager.set_leds()
-msg(f'All times: {times}')
-msg(f'Mean: {sum(times) / NTRIALS}')
-msg(f'Min: {min(times)}')
-msg(f'Max: {max(times)}')
\ No newline at end of file
+for name in FILTERS:
+    msg(f'--- {name} filter')
+    msg(f'All times: {[round(t) for t in times[name]]}')
+    msg(f'Mean: {sum(times[name]) / NTRIALS:.0f}ms')
+    msg(f'Min: {min(times[name]):.0f}ms')
+    msg(f'Max: {max(times[name]):.0f}ms')
+    msg(
+        f'False changes: {false_changes[name]} of {changes[name]} changes '
+        f'({false_changes[name] / max(n_reads, 1) * 1000:.1f} per 1000 frames read)'
+    )
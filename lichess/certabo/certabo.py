@@ -16,6 +16,7 @@ import chess
 # certabo helpers
 from lichess.certabo import codes
 from lichess.certabo import serialreader, btserialreader
+from utils.calibration import calibration_filepath
 
 CERTABO_DATA_PATH = appdirs.user_data_dir("GUI", "Certabo")
 # TODO: Fix this, move it into certabo function
@@ -56,8 +57,7 @@ class Certabo:
         self.move_detect_max_tries = 3
 
         # try to load calibration data (mapping of RFID chip IDs to pieces)
-        calibration_file = f'calibration-{self.portname.replace("/", "").replace(":", "")}.bin'
-        self.calibration_filepath = os.path.join(CERTABO_DATA_PATH, calibration_file)
+        self.calibration_filepath = calibration_filepath(self.portname)
         codes.load_calibration(self.calibration_filepath)
 
         # spawn a serial thread and pass our data handler
@@ -116,8 +116,8 @@ class Certabo:
         else:
             self.send_leds()
 
-    def handle_usb_data(self, data):
-        usb_data = list(map(int, data.split(" ")))
+    def handle_usb_data(self, usb_data):
+        # usb_data is a decoded frame: 320 bytes, one per RFID code
         if self.calibration == True:
             self.calibrate_from_usb_data(usb_data)
         else:
@@ -125,7 +125,7 @@ class Certabo:
                 self.usb_data_history_filled = True
                 self.usb_data_history_i = 0
 
-            self.usb_data_history[self.usb_data_history_i] = list(usb_data)[:]
+            self.usb_data_history[self.usb_data_history_i] = usb_data
             self.usb_data_history_i += 1
             if self.usb_data_history_filled:
                 self.usb_data_processed = codes.statistic_processing(self.usb_data_history, False)
@@ -160,7 +160,7 @@ class Certabo:
         if self.calibration_samples_counter >= 15:
             logging.info( "------- we have collected enough samples for averaging ----")
             usb_data = codes.statistic_processing_for_calibration(self.calibration_samples, False)
-            codes.calibration(usb_data, self.new_setup, self.calibration_data_path)
+            codes.calibration(usb_data, self.new_setup, self.calibration_filepath)
             self.calibration = False
             logging.info('calibration ok') 
             self.send_leds()
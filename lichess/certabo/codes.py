@@ -1,12 +1,34 @@
 from __future__ import print_function
-import pickle
 import os
 import chess
 import logging
 import struct
 
+from utils.calibration import CalibrationError, CalibrationIndex
+from utils.framing import pack_cell
+from utils.get_moves import diff_moves
+
 # data conversion
 p, r, n, b, k, q, P, R, N, B, K, Q = [], [], [], [], [], [], [], [], [], [], [], []
+# code -> piece lookup of the lists above
+index = CalibrationIndex()
+# Order the piece lists have always been scanned in: when pieces share a code,
+# the last one wins
+SCAN_ORDER = "pPrRnNbBqQkK"
+# packed code -> letters of the calibrated variants with that code, in SCAN_ORDER
+matches = {}
+
+
+def index_matches(calibration_index):
+    result = {}
+    for letter in SCAN_ORDER:
+        for key in calibration_index.codes[letter]:
+            result[key] = result.get(key, "") + letter
+    return result
+
+
+def piece_matches(cell):
+    return matches.get(pack_cell(cell), "")
 
 # for calibration
 def cell_codes(n_cell, usb_data):  # n_cell from 0 to 63, 0 at left top
@@ -32,17 +54,17 @@ def get_calibration_file_name(port):
 
 
 def load_calibration(filename):
-    global p, r, n, b, k, q, P, R, N, B, K, Q
+    global p, r, n, b, k, q, P, R, N, B, K, Q, index, matches
     logging.info("codes.py - loading calibration")
     try:
-        p, r, n, b, k, q, P, R, N, B, K, Q = pickle.load(
-            open(filename, "rb")
-        )
+        index = CalibrationIndex.load(filename)
+        p, r, n, b, k, q, P, R, N, B, K, Q = index.to_calibration_data()
+        matches = index_matches(index)
     except (IOError, OSError):
         logging.info("WARNING: no calibration found")
         return False
-    except ValueError:
-        logging.info("Can't load calibration data")
+    except CalibrationError as e:
+        logging.info("Can't load calibration data: %s", e)
         return False
     return True
 
@@ -80,46 +102,9 @@ def statistic_processing_for_calibration(samples, show_print):
 
 
 def get_name(cell):
-    global p, r, n, b, k, q, P, R, N, B, K, Q
-    c = ""
-    if cell_empty(cell):
+    c = piece_matches(cell)[-1:]
+    if c == "" and cell_empty(cell):
         c = "-"
-    for cell_p in p:
-        if compare_cells(cell, cell_p):
-            c = "p"
-    for cell_p in P:
-        if compare_cells(cell, cell_p):
-            c = "P"
-    for cell_p in r:
-        if compare_cells(cell, cell_p):
-            c = "r"
-    for cell_p in R:
-        if compare_cells(cell, cell_p):
-            c = "R"
-    for cell_p in n:
-        if compare_cells(cell, cell_p):
-            c = "n"
-    for cell_p in N:
-        if compare_cells(cell, cell_p):
-            c = "N"
-    for cell_p in b:
-        if compare_cells(cell, cell_p):
-            c = "b"
-    for cell_p in B:
-        if compare_cells(cell, cell_p):
-            c = "B"
-    for cell_p in q:
-        if compare_cells(cell, cell_p):
-            c = "q"
-    for cell_p in Q:
-        if compare_cells(cell, cell_p):
-            c = "Q"
-    for cell_p in k:
-        if compare_cells(cell, cell_p):
-            c = "k"
-    for cell_p in K:
-        if compare_cells(cell, cell_p):
-            c = "K"
     return c
 
 
@@ -198,7 +183,7 @@ def cell_empty(x):
 
 
 def calibration(usb_data, new_setup, filename):
-    global p, r, n, b, k, q, P, R, N, B, K, Q
+    global p, r, n, b, k, q, P, R, N, B, K, Q, index, matches
     prev_results = p, r, n, b, k, q, P, R, N, B, K, Q
 
     p, r, n, b, k, q, P, R, N, B, K, Q = [], [], [], [], [], [], [], [], [], [], [], []
@@ -299,7 +284,9 @@ def calibration(usb_data, new_setup, filename):
             Kn,
             Qn,
         )
-    pickle.dump(results, open(filename, "wb"))
+    index = CalibrationIndex(results)
+    index.save(filename)
+    matches = index_matches(index)
 
     logging.info("----------------")
     # print r
@@ -314,42 +301,7 @@ def calibration(usb_data, new_setup, filename):
             if cell_empty(cell):
                 row.append("-")
             else:  # not empty
-                for cell_p in p:
-                    if compare_cells(cell, cell_p):
-                        row.append("p")
-                for cell_p in P:
-                    if compare_cells(cell, cell_p):
-                        row.append("P")
-                for cell_p in r:
-                    if compare_cells(cell, cell_p):
-                        row.append("r")
-                for cell_p in R:
-                    if compare_cells(cell, cell_p):
-                        row.append("R")
-                for cell_p in n:
-                    if compare_cells(cell, cell_p):
-                        row.append("n")
-                for cell_p in N:
-                    if compare_cells(cell, cell_p):
-                        row.append("N")
-                for cell_p in b:
-                    if compare_cells(cell, cell_p):
-                        row.append("b")
-                for cell_p in B:
-                    if compare_cells(cell, cell_p):
-                        row.append("B")
-                for cell_p in q:
-                    if compare_cells(cell, cell_p):
-                        row.append("q")
-                for cell_p in Q:
-                    if compare_cells(cell, cell_p):
-                        row.append("Q")
-                for cell_p in k:
-                    if compare_cells(cell, cell_p):
-                        row.append("k")
-                for cell_p in K:
-                    if compare_cells(cell, cell_p):
-                        row.append("K")
+                row.extend(piece_matches(cell))
         logging.info(" ".join(row))
 
 
@@ -418,43 +370,7 @@ def usb_data_to_FEN(usb_data, rotate180=False):
                 c = "-"
                 empty_cells_counter += 1
             else:  # not empty
-
-                for cell_p in p:
-                    if compare_cells(cell, cell_p):
-                        c = "p"
-                for cell_p in P:
-                    if compare_cells(cell, cell_p):
-                        c = "P"
-                for cell_p in r:
-                    if compare_cells(cell, cell_p):
-                        c = "r"
-                for cell_p in R:
-                    if compare_cells(cell, cell_p):
-                        c = "R"
-                for cell_p in n:
-                    if compare_cells(cell, cell_p):
-                        c = "n"
-                for cell_p in N:
-                    if compare_cells(cell, cell_p):
-                        c = "N"
-                for cell_p in b:
-                    if compare_cells(cell, cell_p):
-                        c = "b"
-                for cell_p in B:
-                    if compare_cells(cell, cell_p):
-                        c = "B"
-                for cell_p in q:
-                    if compare_cells(cell, cell_p):
-                        c = "q"
-                for cell_p in Q:
-                    if compare_cells(cell, cell_p):
-                        c = "Q"
-                for cell_p in k:
-                    if compare_cells(cell, cell_p):
-                        c = "k"
-                for cell_p in K:
-                    if compare_cells(cell, cell_p):
-                        c = "K"
+                c = piece_matches(cell)[-1:] or "unknown"
 
                 if empty_cells_counter > 0 and c != "-":
                     s += str(empty_cells_counter)
@@ -605,25 +521,14 @@ def get_moves(board, fen, max_depth =2):
     if board.board_fen() == board_fen:
         # logging.debug('Positions identical')
         return []
-    copy_board = board.copy()  # type: chess.Board
-    moves = list(board.generate_legal_moves())
-    for move in moves:
-        copy_board.push(move)
-        if board_fen == copy_board.board_fen():
-            logging.debug('Single move detected - {}'.format(move.uci()))
-            return [move.uci()]
-        copy_board.pop()
-    if max_depth > 1:
-        for move in moves:
-            copy_board.push(move)
-            legal_moves2 = list(copy_board.generate_legal_moves())
-            for move2 in legal_moves2:
-                copy_board.push(move2)
-                if board_fen == copy_board.board_fen():
-                    logging.debug('Double move detected - {}, {}'.format(move.uci(), move2.uci()))
-                    return [move.uci(), move2.uci()]
-                copy_board.pop()
-            copy_board.pop()
+    # Only moves between the squares that differ are tried
+    moves = diff_moves(board, board_fen, check_double_moves=max_depth > 1)
+    if len(moves) == 1:
+        logging.debug('Single move detected - {}'.format(moves[0]))
+        return list(moves)
+    if moves:
+        logging.debug('Double move detected - {}, {}'.format(*moves))
+        return list(moves)
     logging.debug('Unable to detect moves')
     raise InvalidMove()
 
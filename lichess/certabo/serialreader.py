@@ -4,16 +4,13 @@
 # Copyright (c) 2020 by Harald Klein <hari@vt100.at> - All rights reserved
 # 
 
-import time
+import asyncio
 import os
 import sys
 import threading
 import serial
 import logging
 
-if os.name == 'posix':
-    import fcntl
-
 import serial.tools.list_ports
 
 if os.name == 'nt':  # sys.platform == 'win32':
@@ -21,6 +18,8 @@ if os.name == 'nt':  # sys.platform == 'win32':
 elif os.name == 'posix':
     from serial.tools.list_ports_posix import comports
 
+from utils.led_scheduler import load_min_interval_ms
+from utils.transport import BoardLink, SerialTransport
 from utils.usbtool import find_address
 
 
@@ -54,79 +53,36 @@ def find_port_():
 class serialreader(threading.Thread):
     def __init__ (self, handler, device='auto'):
         threading.Thread.__init__(self)
-        self.device = device
-        self.connected = False
         self.handler = handler
-        self.uart = None
-        self.buf = bytearray()
+        transport = SerialTransport(
+            None if device == 'auto' else device, find_address=find_address, lock=True)
+        self.link = BoardLink(
+            'serialreader', transport, self.handle_frame,
+            led_interval_ms=load_min_interval_ms(), on_connect=self.greet)
+
+    @property
+    def connected(self):
+        return self.link.connected
 
     def send_led(self, message: bytes):
         # logging.debug(f'Sending to serial: {message}')
-        if self.connected:
-            return self.uart.write(message)
-        return None
+        self.link.send_leds(message)
 
-    def readline(self):
-        i = self.buf.find(b"\n")
-        if i >= 0:
-            r = self.buf[:i+1]
-            self.buf = self.buf[i+1:]
-            return r
-        while True:
-            i = max(1, min(2048, self.uart.in_waiting))
-            data = self.uart.read(i)
-            i = data.find(b"\n")
-            if i >= 0:
-                r = self.buf + data[:i+1]
-                self.buf[0:] = data[i+1:]
-                return r
-            else:
-                self.buf.extend(data)
+    @staticmethod
+    async def greet(link):
+        logging.info(f'Opened serial port {link.transport.address}')
+        link.transport.port.reset_input_buffer()
+        link.transport.write(b'U\xaaU\xaaU\xaaU\xaa')
+        await asyncio.sleep(1)
+        link.transport.write(b'\xaaU\xaaU\xaaU\xaaU')
+        await asyncio.sleep(1)
+        link.transport.write(b'\x00\x00\x00\x00\x00\x00\x00\x00')
 
-    def run(self):
-        while True:
-            if not self.connected:
-                try:
-                    if self.device == 'auto':
-                        logging.info(f'Auto-detecting serial port')
-                        serialport = find_address()
-                    else:
-                        serialport = self.device
-                        self.device = 'auto'  # If it disconnects after, ignore typed device and try to find new!
-                    if serialport is None:
-                        logging.info(f'No port found, retrying')
-                        time.sleep(1)
-                        continue
-                    logging.info(f'Opening serial port {serialport}')
-                    self.uart = serial.Serial(serialport, 38400)  # 0-COM1, 1-COM2 / speed /
-                    if os.name == 'posix':
-                        logging.debug(f'Attempting to lock {serialport}')
-                        fcntl.flock(self.uart.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
-                    logging.debug(f'Flushing input on {serialport}')
-                    self.uart.flushInput()
-                    self.uart.write(b'U\xaaU\xaaU\xaaU\xaa')
-                    time.sleep(1)
-                    self.uart.write(b'\xaaU\xaaU\xaaU\xaaU')
-                    time.sleep(1)
-                    self.uart.write(b'\x00\x00\x00\x00\x00\x00\x00\x00')
-                    self.connected = True
-                except Exception as e:
-                    logging.info(f'ERROR: Cannot open serial port {serialport}: {str(e)}')
-                    self.connected = False
-                    time.sleep(0.1)
-            else:
-                try:
-                    while True:
-                        # logging.debug(f'serial data pending')
-                        raw_message = self.readline()
-                        try:
-                            message = raw_message.decode("ascii")[1: -3]
-                            if len(message.split(" ")) == 320:  # 64*5
-                                self.handler(message)
-                            message = ""
-                        except Exception as e:
-                            logging.info(f'Exception during message decode: {str(e)}')
-                except Exception as e:
-                    logging.info(f'Exception during serial communication: {str(e)}')
-                    self.connected = False
+    def handle_frame(self, frame):
+        try:
+            self.handler(frame.codes)
+        except Exception as e:
+            logging.info(f'Exception during message decode: {str(e)}')
 
+    def run(self):
+        asyncio.run(self.link.run())
@@ -11,7 +11,15 @@ from concurrent.futures import ThreadPoolExecutor
 import chess.pgn
 
 import cfg
-from utils import bluetoothtool, logger, pypolyglot, reader_writer, usbtool
+from utils import (
+    bluetoothtool,
+    capture,
+    latency,
+    logger,
+    pypolyglot,
+    reader_writer,
+    usbtool,
+)
 from utils.analysis_engine import AnalysisEngine, GameEngine, HintEngine
 from utils.game_clock import GameClock
 from utils.get_books_engines import (
@@ -21,7 +29,14 @@ from utils.get_books_engines import (
     get_engine_list,
     get_saved_games,
 )
-from utils.get_moves import get_moves, is_move_back
+from utils.get_moves import (
+    CATCH_UP_STABLE_TIME,
+    catch_up_moves,
+    get_lifted_square,
+    get_moves,
+    is_move_back,
+    legal_destinations,
+)
 from utils.logger import CERTABO_DATA_PATH
 from utils.messchess import RomEngine
 from utils.publish import Publisher, generate_pgn
@@ -37,6 +52,7 @@ if __name__ == "__main__":
     multiprocessing.freeze_support()
     logger.set_logger()
     log = logger.get_logger()
+    latency.install()
 
     def do_poweroff(method=None):
         if method == "logo":
@@ -132,6 +148,7 @@ if __name__ == "__main__":
         global STATE
         log.debug(f"Switching states: {STATE} -> {new_state}")
         STATE = new_state
+        latency.stage("state")
         DISPLAY.clear_state()
 
         # If not in game (or save) window kill engines and reset UI options
@@ -227,6 +244,11 @@ if __name__ == "__main__":
     if not load_certabo_settings():
         save_certabo_settings()
 
+    if cfg.args.replay is not None:
+        cfg.args.usbport = capture.start_pty_replay(
+            cfg.args.replay, cfg.args.replay_speed
+        )
+
     if cfg.args.usbport is not None:
         SETTINGS["_certabo_settings"]["connection_method"] = "usb"
         SETTINGS["_certabo_settings"]["address_chessboard"] = cfg.args.usbport
@@ -248,6 +270,9 @@ if __name__ == "__main__":
     try:
         STATE = "init"
         MOVES = []
+        # Physical board placement and when it was first read
+        PHYSICAL_FEN = None
+        PHYSICAL_FEN_TIME = None
         RESUMING_NEW_GAME = False
 
         CHESSBOARD_CONNECTION_PROCESS = None
@@ -363,7 +388,9 @@ if __name__ == "__main__":
                         )
                         if CONNECTION_TYPE == "usb":
                             CHESSBOARD_CONNECTION_PROCESS = usbtool.start_usbtool(
-                                CONNECTION_ADDRESS, separate_process=True
+                                CONNECTION_ADDRESS,
+                                separate_process=True,
+                                transport=cfg.args.frame_transport,
                             )
                         else:
                             CHESSBOARD_CONNECTION_PROCESS = (
@@ -700,6 +727,9 @@ if __name__ == "__main__":
                 rotated_physical_chessboard_fen = USB_READER.read_board(
                     SETTINGS["rotate180"], update=False
                 )
+                if rotated_physical_chessboard_fen != PHYSICAL_FEN:
+                    PHYSICAL_FEN = rotated_physical_chessboard_fen
+                    PHYSICAL_FEN_TIME = time.time()
 
                 # Check if game over (but not if in exit dialog)
                 # TODO: Move this to a completely separate state, similar to save_game
@@ -748,14 +778,44 @@ if __name__ == "__main__":
                         and not sum(REMOTE_CONTROL.exit_command_initiated.values())
                     ):
 
-                        MOVES = get_moves(
+                        lifted_square = get_lifted_square(
                             SETTINGS["virtual_chessboard"],
                             rotated_physical_chessboard_fen,
-                            check_double_moves=SETTINGS["human_game"],
                         )
+                        if lifted_square is not None:
+                            # Piece is being moved: show where it can go
+                            MOVES = []
+                            LED_MANAGER.set_leds(
+                                legal_destinations(
+                                    SETTINGS["virtual_chessboard"], lifted_square
+                                ),
+                                SETTINGS["rotate180"],
+                            )
+                        else:
+                            MOVES = get_moves(
+                                SETTINGS["virtual_chessboard"],
+                                rotated_physical_chessboard_fen,
+                                check_double_moves=SETTINGS["human_game"],
+                                engine=cfg.args.move_engine,
+                            )
+                            # Board may be several moves ahead if readings
+                            # were missed (e.g. while reconnecting)
+                            if (
+                                not MOVES
+                                and SETTINGS["human_game"]
+                                and time.time() - PHYSICAL_FEN_TIME
+                                >= CATCH_UP_STABLE_TIME
+                            ):
+                                MOVES = catch_up_moves(
+                                    SETTINGS["virtual_chessboard"],
+                                    rotated_physical_chessboard_fen,
+                                )
+                                if MOVES:
+                                    log.info(f"Catching up with moves: {MOVES}")
                         if MOVES:
+                            latency.stage("move")
                             switch_state("game_do_user_move")
-                        else:
+                        elif lifted_square is None:
                             if not SETTINGS["_game_engine"]["is_rom"] and is_move_back(
                                 SETTINGS["virtual_chessboard"],
                                 rotated_physical_chessboard_fen,
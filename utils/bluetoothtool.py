@@ -1,14 +1,14 @@
+import asyncio
 import multiprocessing
-import queue
-import select
 import threading
-import time
 
 import bluetooth
 
 import cfg
 from utils import usbtool
+from utils.framing import ChangeFilter
 from utils.logger import get_logger
+from utils.transport import BluetoothTransport, BoardLink
 
 log = get_logger()
 
@@ -16,68 +16,20 @@ log = get_logger()
 def _bluetothtool(address_chessboard, queue_to_usbtool, queue_from_usbtool):
     log.debug("Starting Bluetoothtool")
 
-    socket = None
-    socket_ok = False
-    first_connection = True
-
-    while True:
-        time.sleep(0.001)
-
-        # Try to (re)connect to board
-        if not socket_ok:
-            try:
-                if not first_connection:
-                    socket.close()
-                    address_chessboard = (
-                        find_address() if cfg.args.btport is None else cfg.args.btport
-                    )
-                    if address_chessboard is None:
-                        time.sleep(0.5)
-                        continue
-
-                socket = bluetooth.BluetoothSocket(bluetooth.RFCOMM)
-                socket.connect((address_chessboard, cfg.BTPORT))
-
-            # pylint: disable=broad-except
-            except Exception as exc:
-                # pylint: enable=broad-except
-                log.warning(
-                    f"Failed to (re)connect to port {address_chessboard}: {exc}"
-                )
-                time.sleep(1)
-                continue
-
-            else:
-                socket_ok = True
-                socket_list = [socket]
-                if first_connection:
-                    first_connection = False
-
-        # Write led info
-        try:
-            new_message = queue_to_usbtool.get_nowait()
-            socket.send(new_message)
-        except queue.Empty:
-            pass
-        except bluetooth.btcommon.BluetoothError as err:
-            log.warning(f"Lost connection to device: {err}")
-            socket_ok = False
-            continue
-
-        # Read board info
-        readable, _, _ = select.select(socket_list, [], [], 0)
-        if readable:
-            try:
-                data = socket.recv(1024).decode("utf-8")
-                # If no data, port is probably closed
-                if not data:
-                    log.warning("Lost connection to device: no data")
-                    socket_ok = False
-                    continue
-                queue_from_usbtool.put(data)
-            except bluetooth.btcommon.BluetoothError as err:
-                log.warning(f"Lost connection to device: {err}")
-                socket_ok = False
+    # LED messages are throttled by usbtool on the bluetooth server, which
+    # forwards every frame, so unchanged frames are dropped here
+    transport = BluetoothTransport(
+        address_chessboard,
+        find_address=find_address if cfg.args.btport is None else None,
+    )
+    link = BoardLink(
+        "Bluetoothtool",
+        transport,
+        queue_from_usbtool.put,
+        change_filter=ChangeFilter(),
+        record_path=cfg.args.record,
+    )
+    asyncio.run(link.run(led_queue=queue_to_usbtool))
 
 
 def start_bluetoothtool(address_chessboard, separate_process=False):
@@ -0,0 +1,291 @@
+"""
+Calibration index: maps the RFID codes of a cell to the piece standing on it.
+
+Codes of a cell are packed into one 40-bit integer key (see
+utils.framing.pack_cell), so a cell is looked up with a single dict access.
+
+Calibration files (calibration-<port>.cal) are laid out as (little endian):
+    header: magic b"CRTBCAL", version (u8), number of code variants of each
+        piece in CALIBRATION_ORDER (12 x u16), CRC32 of the codes (u32)
+    codes: 5 bytes per code variant, grouped by piece in CALIBRATION_ORDER
+
+With nearest matching, a code that is not calibrated is matched to the piece
+whose code differs from it in a single byte (a misread byte), unless codes of
+different pieces are that close. Each calibrated code is indexed once per byte
+position with that byte cleared, so a lookup takes 5 dict accesses.
+
+Older versions stored pickled lists of 12 lists of 5-code variants, in the same
+order, in calibration-<port>.bin. Those are converted the first time they are
+loaded (and left in place).
+"""
+import os
+import pickle
+import struct
+import zlib
+from collections import Counter
+
+from utils.framing import cell_keys, pack_cell
+
+# utils.logger is only imported where needed, so that tools with their own
+# command line (it parses cfg) can read calibration files
+
+CALIBRATION_ORDER = "prnbkqPRNBKQ"
+EMPTY_KEY = 0
+CELL_SIZE = 5
+# Masks clearing each byte of a packed key, and marks of the byte cleared
+_BYTE_MASKS = tuple(
+    (2 ** 40 - 1) ^ (0xFF << (8 * (CELL_SIZE - 1 - position)))
+    for position in range(CELL_SIZE)
+)
+_POSITION_MARKS = tuple(position << 40 for position in range(CELL_SIZE))
+_AMBIGUOUS = object()
+
+MAGIC = b"CRTBCAL"
+VERSION = 1
+EXTENSION = ".cal"
+LEGACY_EXTENSION = ".bin"
+
+_HEADER = struct.Struct("<7sB12HI")
+
+# Loaded indexes, by calibration file path
+_INDEXES = {}
+
+
+class CalibrationError(ValueError):
+    """
+    Calibration file is corrupted or in an unknown format
+    """
+
+
+def calibration_filepath(portname):
+    """
+    Return path of the calibration file of the board connected to portname
+    """
+    from utils.logger import (  # pylint: disable=import-outside-toplevel
+        CERTABO_DATA_PATH,
+    )
+
+    portname = portname.replace("/", "").replace(":", "")
+    return os.path.join(CERTABO_DATA_PATH, f"calibration-{portname}{EXTENSION}")
+
+
+class _LegacyUnpickler(pickle.Unpickler):
+    """
+    Pickled calibrations only hold lists, tuples and ints: refuse anything else
+    """
+
+    def find_class(self, module, name):
+        raise pickle.UnpicklingError(f"Unexpected {module}.{name} in calibration")
+
+
+class CalibrationIndex:
+    def __init__(self, calibration_data=()):
+        # Packed key -> piece letter ("." for the empty cell)
+        self.pieces = {}
+        # Piece letter -> packed keys, in calibration order
+        self.codes = {letter: [] for letter in CALIBRATION_ORDER}
+        for letter, piece in zip(CALIBRATION_ORDER, calibration_data):
+            for piece_variation in piece:
+                key = pack_cell(piece_variation)
+                self.pieces[key] = letter
+                self.codes[letter].append(key)
+        self.pieces[EMPTY_KEY] = "."
+
+        # Masked key -> (piece, calibrated key), built on first nearest match
+        self.near_pieces = None
+        # (piece, calibrated key, misread byte) -> number of matches
+        self.near_matches = Counter()
+        self.ambiguous_matches = 0
+
+    def _build_near_pieces(self):
+        near_pieces = {}
+        for key, letter in self.pieces.items():
+            for mask, mark in zip(_BYTE_MASKS, _POSITION_MARKS):
+                near_key = key & mask | mark
+                match = near_pieces.get(near_key)
+                if match is None:
+                    near_pieces[near_key] = (letter, key)
+                elif match is not _AMBIGUOUS and match[0] != letter:
+                    near_pieces[near_key] = _AMBIGUOUS
+        self.near_pieces = near_pieces
+
+    def nearest(self, key):
+        """
+        Return piece with a code differing from key in at most one byte, or
+        None if there is none or if codes of several pieces are that close
+        """
+        piece = self.pieces.get(key)
+        if piece is not None:
+            return piece
+        if self.near_pieces is None:
+            self._build_near_pieces()
+
+        found = None
+        found_piece = None
+        for position, (mask, mark) in enumerate(zip(_BYTE_MASKS, _POSITION_MARKS)):
+            match = self.near_pieces.get(key & mask | mark)
+            if match is None:
+                continue
+            if match is _AMBIGUOUS or found_piece not in (None, match[0]):
+                self.ambiguous_matches += 1
+                return None
+            found_piece = match[0]
+            found = (found_piece, match[1], position)
+        if found is None:
+            return None
+        self.near_matches[found] += 1
+        return found_piece
+
+    @classmethod
+    def from_bytes(cls, data, path="calibration"):
+        """
+        Return index of the contents of a calibration file
+        """
+        if len(data) < _HEADER.size:
+            raise CalibrationError(f"{path} is truncated")
+        magic, version, *counts, crc = _HEADER.unpack_from(data)
+        if magic != MAGIC:
+            raise CalibrationError(f"{path} is not a calibration file")
+        if version != VERSION:
+            raise CalibrationError(
+                f"Unsupported calibration version {version} in {path}"
+            )
+        codes = data[_HEADER.size :]
+        if len(codes) != sum(counts) * CELL_SIZE:
+            raise CalibrationError(f"{path} is truncated")
+        if zlib.crc32(codes) != crc:
+            raise CalibrationError(f"{path} is corrupted (bad checksum)")
+
+        index = cls()
+        position = 0
+        for letter, count in zip(CALIBRATION_ORDER, counts):
+            for _ in range(count):
+                key = int.from_bytes(codes[position : position + CELL_SIZE], "big")
+                position += CELL_SIZE
+                index.pieces[key] = letter
+                index.codes[letter].append(key)
+        index.pieces[EMPTY_KEY] = "."
+        return index
+
+    def to_bytes(self):
+        codes = b"".join(
+            key.to_bytes(CELL_SIZE, "big")
+            for letter in CALIBRATION_ORDER
+            for key in self.codes[letter]
+        )
+        counts = [len(self.codes[letter]) for letter in CALIBRATION_ORDER]
+        return _HEADER.pack(MAGIC, VERSION, *counts, zlib.crc32(codes)) + codes
+
+    @classmethod
+    def load_legacy(cls, path):
+        """
+        Return index of a pickled calibration file
+        """
+        try:
+            with open(path, "rb") as file:
+                data = _LegacyUnpickler(file).load()
+            for piece in data:
+                for piece_variation in piece:
+                    # Each variant must fit in a packed key (5 codes of a byte)
+                    if len(piece_variation) != CELL_SIZE or not all(
+                        isinstance(code, int) and 0 <= code <= 255
+                        for code in piece_variation
+                    ):
+                        raise ValueError(f"invalid code {piece_variation!r}")
+            return cls(data)
+        except (pickle.UnpicklingError, EOFError, TypeError, ValueError) as exc:
+            raise CalibrationError(f"{path} is corrupted ({exc})") from exc
+
+    @classmethod
+    def load(cls, path):
+        """
+        Return index of a calibration file, only read again if it was modified.
+
+        Raises FileNotFoundError if there is no calibration and CalibrationError
+        if it cannot be read.
+        """
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            legacy_path = os.path.splitext(path)[0] + LEGACY_EXTENSION
+            if not os.path.exists(legacy_path):
+                raise
+            from utils.logger import (  # pylint: disable=import-outside-toplevel
+                get_logger,
+            )
+
+            index = cls.load_legacy(legacy_path)
+            index.save(path)
+            get_logger().info(f"Converted calibration file {legacy_path} to {path}")
+            return index
+
+        cached = _INDEXES.get(path)
+        if cached is not None and cached[0] == (stat.st_mtime_ns, stat.st_size):
+            return cached[1]
+        with open(path, "rb") as file:
+            index = cls.from_bytes(file.read(), path)
+        _INDEXES[path] = ((stat.st_mtime_ns, stat.st_size), index)
+        return index
+
+    def save(self, path):
+        # Write to a temporary file first, so that a crash cannot leave a
+        # half written calibration
+        temp_path = f"{path}.tmp"
+        with open(temp_path, "wb") as file:
+            file.write(self.to_bytes())
+        os.replace(temp_path, path)
+        stat = os.stat(path)
+        _INDEXES[path] = ((stat.st_mtime_ns, stat.st_size), self)
+
+    def __len__(self):
+        """
+        Number of calibrated code variants (the empty cell is not one)
+        """
+        return sum(map(len, self.codes.values()))
+
+    def get(self, key, default=None):
+        return self.pieces.get(key, default)
+
+    def piece(self, cell_codes, default=None):
+        """
+        Return piece with the 5 codes of a cell
+        """
+        return self.pieces.get(pack_cell(cell_codes), default)
+
+    def frame_pieces(self, codes, default="?", nearest=False):
+        """
+        Return the pieces of the 64 cells of a decoded frame (a8 first, h1 last)
+        """
+        keys = cell_keys(codes)
+        get_piece = self.pieces.get
+        if not nearest:
+            return [get_piece(key, default) for key in keys]
+        pieces = [get_piece(key) for key in keys]
+        for cell, piece in enumerate(pieces):
+            if piece is None:
+                pieces[cell] = self.nearest(keys[cell]) or default
+        return pieces
+
+    def pop_match_stats(self):
+        """
+        Return and reset counts of nearest matches: list of (piece, calibrated
+        code, misread byte, matches), most common first, and number of
+        ambiguous codes
+        """
+        near_matches = [
+            (letter, list(key.to_bytes(CELL_SIZE, "big")), position, count)
+            for (letter, key, position), count in self.near_matches.most_common()
+        ]
+        ambiguous_matches = self.ambiguous_matches
+        self.near_matches.clear()
+        self.ambiguous_matches = 0
+        return near_matches, ambiguous_matches
+
+    def piece_codes(self, letter):
+        """
+        Return the code variants (lists of 5 codes) calibrated for a piece
+        """
+        return [list(key.to_bytes(CELL_SIZE, "big")) for key in self.codes[letter]]
+
+    def to_calibration_data(self):
+        return [self.piece_codes(letter) for letter in CALIBRATION_ORDER]
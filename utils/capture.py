@@ -0,0 +1,160 @@
+"""
+Capture files: timestamped board frames and LED writes of a board session,
+recorded by usbtool / bluetoothtool with --record and played back with --replay.
+
+Layout (little endian):
+    header: magic b"CRTBCAP", version (u8), start time (f64, epoch seconds)
+    records: kind (1 byte), seconds since start (f64), payload length (u16), payload
+
+Record kinds:
+    F: frame, decoded into 320 codes (see utils.framing)
+    R: raw line that could not be decoded, kept as received (without b"\\n")
+    L: LED message written to the board (8 bytes)
+"""
+import os
+import select
+import struct
+import threading
+import time
+from collections import namedtuple
+
+from utils.framing import ChangeFilter, decode_frame, encode_frame
+from utils.logger import cfg, get_logger
+
+log = get_logger()
+
+MAGIC = b"CRTBCAP"
+VERSION = 1
+KIND_FRAME = b"F"
+KIND_RAW = b"R"
+KIND_LEDS = b"L"
+
+_HEADER = struct.Struct("<7sBd")
+_RECORD = struct.Struct("<cdH")
+
+CaptureRecord = namedtuple("CaptureRecord", ("kind", "time", "payload"))
+
+
+class CaptureWriter:
+    def __init__(self, path):
+        self.path = path
+        self.start_time = time.time()
+        self.file = open(path, "wb")  # pylint: disable=consider-using-with
+        self.file.write(_HEADER.pack(MAGIC, VERSION, self.start_time))
+        log.info(f"Recording board session to {path}")
+
+    def _write(self, kind, now, payload):
+        self.file.write(_RECORD.pack(kind, now - self.start_time, len(payload)))
+        self.file.write(payload)
+
+    def write_lines(self, lines, now):
+        """
+        Record lines returned by FrameBuffer.pop_frames
+        """
+        for line in lines:
+            codes = decode_frame(line)
+            if codes is None:
+                self._write(KIND_RAW, now, line)
+            else:
+                self._write(KIND_FRAME, now, codes)
+        self.file.flush()
+
+    def write_leds(self, leds, now):
+        self._write(KIND_LEDS, now, leds)
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+def read_capture(path):
+    """
+    Yield the CaptureRecords stored in a capture file
+    """
+    with open(path, "rb") as file:
+        header = file.read(_HEADER.size)
+        if len(header) < _HEADER.size:
+            raise ValueError(f"{path} is not a capture file")
+        magic, version, _ = _HEADER.unpack(header)
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a capture file")
+        if version != VERSION:
+            raise ValueError(f"Unsupported capture version {version} in {path}")
+
+        while True:
+            record_header = file.read(_RECORD.size)
+            if len(record_header) < _RECORD.size:
+                # End of file (or capture interrupted while writing a record)
+                return
+            kind, record_time, length = _RECORD.unpack(record_header)
+            payload = file.read(length)
+            if len(payload) < length:
+                return
+            yield CaptureRecord(kind, record_time, payload)
+
+
+def _paced(records, speed):
+    """
+    Yield records at their recorded times divided by speed (speed=None means as
+    fast as possible)
+    """
+    start = time.monotonic()
+    for record in records:
+        if speed:
+            delay = start + record.time / speed - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+        yield record
+
+
+def replay_to_queue(path, queue_obj, speed=None):
+    """
+    Put the frames of a capture in queue_obj, filtered as usbtool would do it.
+
+    The recorded times (not the wall clock) are given to ChangeFilter, so that
+    the output is deterministic at any speed. Returns number of frames put.
+    """
+    change_filter = ChangeFilter()
+    n_frames = 0
+    for record in _paced(read_capture(path), speed):
+        if record.kind != KIND_FRAME:
+            continue
+        frame = change_filter.filter(record.payload, record.time)
+        if frame is not None:
+            queue_obj.put(frame)
+            n_frames += 1
+    return n_frames
+
+
+def _replay_to_pty(path, speed, master):
+    for record in _paced(read_capture(path), speed):
+        if record.kind == KIND_FRAME:
+            os.write(master, encode_frame(record.payload))
+        elif record.kind == KIND_RAW:
+            os.write(master, record.payload + b"\n")
+
+        # Discard LED messages written by the program under test
+        readable, _, _ = select.select([master], [], [], 0)
+        if readable:
+            leds = os.read(master, 4096)
+            if cfg.DEBUG_LED:
+                log.debug(f"Replay: LED message from program - {list(leds)}")
+    log.info(f"Replay of {path} finished")
+
+
+def start_pty_replay(path, speed=1.0):
+    """
+    Play a capture through a pseudo-terminal, which can be opened as the board
+    serial port (posix only). Returns the pty device name.
+    """
+    import tty  # pylint: disable=import-outside-toplevel
+
+    # Slave end is never closed, so that the pty survives reconnections
+    master, slave = os.openpty()
+    tty.setraw(master)
+    name = os.ttyname(slave)
+    threading.Thread(
+        target=_replay_to_pty, args=(path, speed, master), daemon=True
+    ).start()
+    log.info(f"Replaying {path} on {name} (speed={speed or 'max'})")
+    return name
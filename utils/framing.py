@@ -0,0 +1,205 @@
+"""
+Splitting and decoding of the raw Certabo serial stream into board frames.
+
+A board frame is a single line of text: a leading ':' followed by 320 space
+separated decimal codes (64 cells * 5 RFID bytes) and a trailing ' \\r\\n'.
+
+Frames are decoded once, in the reader thread, into a 320 byte `bytes` object
+(one byte per code), which is what every consumer works with afterwards. Cell
+n (0 = a8, 63 = h1) is codes[n * 5 : n * 5 + 5].
+"""
+import struct
+from collections import namedtuple
+
+FRAME_SEPARATOR = b"\n"
+FRAME_TOKENS = 320  # 64 cells * 5 codes
+# Seconds between heartbeats of an unchanged board: well above the 0.21-0.34s
+# the board takes to send a frame at 38400 baud, so that most of its frames are
+# dropped, and below BoardReader's warning of a board that is not read
+HEARTBEAT_INTERVAL = 2.0
+
+_CODE_STRINGS = tuple(str(code).encode("ascii") for code in range(256))
+_CELLS = struct.Struct(">" + "IB" * 64)
+
+# Message sent by usbtool for each forwarded frame: decoded codes, number of
+# consecutive board readings with those same codes it stands for, number of
+# malformed frames (not 320 codes) dropped since the previous forwarded frame,
+# time the frame was received (seconds since epoch, None if unknown) and board
+# readings of the frames skipped by the consumer since the previous one (see
+# SharedFrameRing.get_latest)
+BoardFrame = namedtuple(
+    "BoardFrame",
+    ("codes", "repeats", "dropped", "time", "skipped"),
+    defaults=(0, None, 0),
+)
+
+
+class FrameBuffer:
+    """
+    Reusable bytearray that accumulates raw serial data and splits it into frames
+    using offset-based newline searches.
+
+    Data is appended after `end`, complete lines are sliced out from `start`, and
+    the buffer rewinds to the beginning whenever it is fully consumed, so in steady
+    state no memory is allocated except for the returned frames themselves.
+    """
+
+    def __init__(self, size=8192):
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+        self.size = size
+        self.start = 0  # First byte not yet returned as part of a frame
+        self.end = 0  # One past the last byte received
+        self.scan = 0  # Where to resume looking for a separator
+        self.overflows = 0
+
+    def __len__(self):
+        return self.end - self.start
+
+    def clear(self):
+        self.start = self.end = self.scan = 0
+
+    def _reserve(self, n_bytes):
+        """
+        Make sure there is room for n_bytes after self.end
+        """
+        if self.end + n_bytes <= self.size:
+            return
+
+        # Move pending (incomplete) data back to the start of the buffer
+        pending = self.end - self.start
+        if self.start:
+            self.buffer[:pending] = self.buffer[self.start : self.end]
+            self.scan -= self.start
+            self.start, self.end = 0, pending
+
+        # Garbage without any separator that would never fit: drop it
+        if pending + n_bytes > self.size:
+            self.overflows += 1
+            self.clear()
+
+    def feed(self, data):
+        """
+        Append raw bytes to the buffer
+        """
+        n_bytes = len(data)
+        if n_bytes > self.size:
+            data = data[-self.size :]
+            n_bytes = self.size
+        self._reserve(n_bytes)
+        self.view[self.end : self.end + n_bytes] = data
+        self.end += n_bytes
+
+    def read_from(self, device):
+        """
+        Read everything that is waiting in a serial device in one call.
+        Returns number of bytes read.
+        """
+        n_bytes = device.in_waiting
+        if n_bytes:
+            self.feed(device.read(n_bytes))
+        return n_bytes
+
+    def pop_frames(self):
+        """
+        Return list of complete lines (without the separator) found in the buffer
+        """
+        frames = []
+        buffer = self.buffer
+        while True:
+            index = buffer.find(FRAME_SEPARATOR, self.scan, self.end)
+            if index < 0:
+                self.scan = self.end
+                break
+            frames.append(bytes(self.view[self.start : index]))
+            self.start = self.scan = index + 1
+
+        if self.start == self.end:
+            self.clear()
+        return frames
+
+
+def decode_frame(line):
+    """
+    Convert a raw frame line to a 320 byte `bytes` object.
+    Returns None if the line does not contain exactly 64*5 codes between 0 and 255.
+    """
+    try:
+        codes = bytes(map(int, line.lstrip(b":").split()))
+    except ValueError:
+        return None
+    if len(codes) != FRAME_TOKENS:
+        return None
+    return codes
+
+
+def pack_cell(cell_codes):
+    """
+    Pack the 5 codes of a cell into a 40-bit integer key
+    """
+    return int.from_bytes(bytes(cell_codes), "big")
+
+
+def cell_keys(codes):
+    """
+    Return the 64 packed cell keys of a decoded frame (a8 first, h1 last)
+    """
+    values = _CELLS.unpack(codes)
+    return [values[i] << 8 | values[i + 1] for i in range(0, 128, 2)]
+
+
+def encode_frame(codes):
+    """
+    Convert decoded frame back to the raw line format sent by the board
+    (used to forward frames over bluetooth)
+    """
+    return b":" + b" ".join(map(_CODE_STRINGS.__getitem__, codes)) + b" \r\n"
+
+
+class ChangeFilter:
+    """
+    Drops unchanged frames at the source, so that a quiet board does not flood
+    the main process with identical readings.
+
+    Each frame is compared with the previous one (comparing 320 bytes costs
+    about as much as hashing them, and cannot collide). A frame is forwarded
+    when it differs from the previous one, and so are its first `confirmations`
+    repetitions, which are what BoardReader needs to fill its history. Further
+    repetitions are only counted, and a heartbeat carrying that count is
+    forwarded every `heartbeat` seconds, to keep calibration sampling and
+    liveness checks going.
+    """
+
+    def __init__(self, confirmations=3, heartbeat=HEARTBEAT_INTERVAL):
+        self.confirmations = confirmations
+        self.heartbeat = heartbeat
+        self.last_codes = None
+        self.consecutive = 0
+        self.pending_repeats = 0
+        self.last_forward_time = 0
+
+    def reset(self):
+        self.last_codes = None
+        self.consecutive = self.pending_repeats = 0
+
+    def filter(self, codes, now):
+        """
+        Return BoardFrame to be forwarded or None if frame should be dropped
+        """
+        if codes != self.last_codes:
+            # Repetitions of the previous frame that were not yet reported are lost
+            self.last_codes = codes
+            self.consecutive = 0
+            self.pending_repeats = 0
+        self.consecutive += 1
+        self.pending_repeats += 1
+
+        if (
+            self.consecutive <= self.confirmations
+            or now - self.last_forward_time >= self.heartbeat
+        ):
+            frame = BoardFrame(codes, self.pending_repeats)
+            self.pending_repeats = 0
+            self.last_forward_time = now
+            return frame
+        return None
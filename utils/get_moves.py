@@ -1,44 +1,375 @@
+"""
+Recognition of the moves played on the physical board.
+
+For each position of the virtual board, a MoveIndex maps the placements that
+legal moves (and, in human games, pairs of moves) lead to to those moves. It is
+built the first time the position is looked up (two-move sequences only when
+first needed), after which every physical board reading is a dict lookup.
+Placements are keyed by their piece bitboards instead of FEN strings.
+
+The "diff" engine does not build an index: the squares where the physical and
+virtual placements differ are found by XORing their bitboards, and only legal
+moves from (and to) those squares are tried. A move changes 2 to 4 squares and
+two moves at most 8, so only a handful of moves are pushed, even for double
+moves.
+
+When the physical board got several moves ahead of the game (readings missed
+while disconnected), catch_up_moves searches breadth-first for the shortest
+sequence of legal moves leading to it. Each call searches within a short time
+limit, and an unfinished search is resumed by the next calls for the same
+placement.
+"""
+import time
+
+import chess
 from lru import LRU
 
-get_moves_cache = LRU(8)
 
+def placement_key(board):
+    """
+    Return hashable key of the piece placement of a python-chess board
+    """
+    return (
+        board.pawns,
+        board.knights,
+        board.bishops,
+        board.rooks,
+        board.queens,
+        board.kings,
+        board.occupied_co[chess.WHITE],
+    )
 
-def get_moves(virtual_board, physical_fen, check_double_moves=False):
-    virtual_fen = virtual_board.board_fen()
-    caching_key = (virtual_fen, physical_fen, check_double_moves)
+
+# Placements of the physical board FENs last looked up
+physical_keys_cache = LRU(64)
+
+
+def physical_key(physical_fen):
+    try:
+        return physical_keys_cache[physical_fen]
+    except KeyError:
+        pass
+    try:
+        key = placement_key(chess.BaseBoard(physical_fen))
+    except ValueError:
+        key = None
+    physical_keys_cache[physical_fen] = key
+    return key
+
+
+class MoveIndex:
+    def __init__(self, board):
+        self.board = board.copy(stack=False)
+        self.moves = list(self.board.generate_legal_moves())
+        # Placement key -> moves (uci) leading to it. If several moves lead to
+        # the same placement, the first one generated is kept
+        self.single_moves = {}
+        for move in self.moves:
+            self.board.push(move)
+            self.single_moves.setdefault(placement_key(self.board), [move.uci()])
+            self.board.pop()
+        self.double_moves = None
+
+    def build_double_moves(self):
+        double_moves = {}
+        for move in self.moves:
+            self.board.push(move)
+            for move2 in self.board.generate_legal_moves():
+                self.board.push(move2)
+                double_moves.setdefault(
+                    placement_key(self.board), [move.uci(), move2.uci()]
+                )
+                self.board.pop()
+            self.board.pop()
+        self.double_moves = double_moves
+
+    def get(self, key, check_double_moves=False):
+        result = self.single_moves.get(key)
+        if result is None and check_double_moves:
+            if self.double_moves is None:
+                self.build_double_moves()
+            result = self.double_moves.get(key)
+        return [] if result is None else result
+
+
+def position_key(board):
+    """
+    Return hashable key of the placement and of what legal moves depend on
+    """
+    return (placement_key(board), board.turn, board.castling_rights, board.ep_square)
+
+
+move_index_cache = LRU(8)
+
+
+def get_move_index(virtual_board):
+    """
+    Return MoveIndex of the current position of virtual_board
+    """
+    index_key = position_key(virtual_board)
+    try:
+        return move_index_cache[index_key]
+    except KeyError:
+        pass
+    move_index = move_index_cache[index_key] = MoveIndex(virtual_board)
+    return move_index
+
+
+def index_moves(virtual_board, physical_fen, check_double_moves=False):
+    key = physical_key(physical_fen)
+    if key is None:
+        return []
+    return get_move_index(virtual_board).get(key, check_double_moves)
+
+
+def changed_squares_mask(board, key):
+    """
+    Return bitboard of the squares where the placement of board differs from
+    the placement key
+    """
+    pawns, knights, bishops, rooks, queens, kings, white = key
+    return (
+        (board.pawns ^ pawns)
+        | (board.knights ^ knights)
+        | (board.bishops ^ bishops)
+        | (board.rooks ^ rooks)
+        | (board.queens ^ queens)
+        | (board.kings ^ kings)
+        | (board.occupied_co[chess.WHITE] ^ white)
+    )
+
+
+def find_diff_moves(virtual_board, key, check_double_moves=False):
+    changed = changed_squares_mask(virtual_board, key)
+    if not changed:
+        return []
+    n_changed = chess.popcount(changed)
+    board = virtual_board.copy(stack=False)
+
+    # Both squares of a move change (and the captured pawn of en passant or
+    # the rook of castling, whose square is the castling move target mask)
+    if n_changed <= 4:
+        for move in board.generate_legal_moves(changed, changed):
+            board.push(move)
+            if placement_key(board) == key:
+                return [move.uci()]
+            board.pop()
+
+    if check_double_moves and n_changed <= 8:
+        # The first move always leaves a changed square, and lands on one
+        # unless the reply recaptures there with the same kind of piece
+        for move in board.generate_legal_moves(changed, chess.BB_ALL):
+            board.push(move)
+            to_mask = changed | chess.BB_SQUARES[move.to_square]
+            for move2 in board.generate_legal_moves(changed, to_mask):
+                board.push(move2)
+                if placement_key(board) == key:
+                    return [move.uci(), move2.uci()]
+                board.pop()
+            board.pop()
+    return []
+
+
+diff_moves_cache = LRU(8)
+
+
+def diff_moves(virtual_board, physical_fen, check_double_moves=False):
+    key = physical_key(physical_fen)
+    if key is None:
+        return []
+    caching_key = (position_key(virtual_board), key, check_double_moves)
+    try:
+        return diff_moves_cache[caching_key]
+    except KeyError:
+        pass
+    result = diff_moves_cache[caching_key] = find_diff_moves(
+        virtual_board, key, check_double_moves
+    )
+    return result
+
+
+MOVE_ENGINES = {"index": index_moves, "diff": diff_moves}
+
+
+CATCH_UP_MAX_PLIES = 6
+CATCH_UP_TIME_LIMIT = 0.05  # seconds
+# Search time after which a placement is given up (a search that does not
+# finish within CATCH_UP_TIME_LIMIT is resumed on the next calls)
+CATCH_UP_TOTAL_TIME_LIMIT = 1.0  # seconds
+# Seconds a physical placement must be read unchanged before catching up with
+# it: the search is too slow to run on every transient placement (pieces in
+# hand), and misplaced pieces are only reported after 3 seconds
+CATCH_UP_STABLE_TIME = 1.0
+
+
+def can_reach(board, key, plies):
+    """
+    Return False if the placement key cannot be reached from board in plies
+    moves: each move puts a single piece on a square (two when castling), so
+    each side needs as many moves as pieces of its own not yet in place
+    """
+    changed = changed_squares_mask(board, key)
+    white = key[6]
+    black = (key[0] | key[1] | key[2] | key[3] | key[4] | key[5]) & ~white
+    for color, placed in ((board.turn, (plies + 1) // 2), (not board.turn, plies // 2)):
+        if board.has_castling_rights(color):
+            placed *= 2
+        missing = changed & (white if color == chess.WHITE else black)
+        if chess.popcount(missing) > placed:
+            return False
+    return True
+
+
+def find_catch_up_moves(virtual_board, key, max_plies):
+    """
+    Breadth-first search of the shortest sequence of legal moves leading to the
+    placement key. This is a generator that yields before each move tried, so
+    that the search can be interrupted and resumed (see catch_up_moves). It
+    returns the moves (uci), or None if there are none.
+
+    Only moves from squares that differ from the placement, or that were
+    reached earlier in the sequence, are tried: sequences moving a piece away
+    and bringing an identical one back to its square are not found. Positions
+    reached by several sequences are only expanded once (they are identified
+    by position_key, which holds what a Zobrist hash is computed from).
+    """
+    board = virtual_board.copy(stack=False)
+    frontier = [(board, [], 0)]
+    seen = {position_key(board)}
+    for ply in range(max_plies):
+        next_frontier = []
+        for node, moves, touched in frontier:
+            from_mask = changed_squares_mask(node, key) | touched
+            for move in list(node.generate_legal_moves(from_mask, chess.BB_ALL)):
+                yield
+                node.push(move)
+                try:
+                    if placement_key(node) == key:
+                        return moves + [move.uci()]
+                    if not can_reach(node, key, max_plies - ply - 1):
+                        continue
+                    child_key = position_key(node)
+                    if child_key in seen:
+                        continue
+                    seen.add(child_key)
+                    next_frontier.append(
+                        (
+                            node.copy(stack=False),
+                            moves + [move.uci()],
+                            touched | chess.BB_SQUARES[move.to_square],
+                        )
+                    )
+                finally:
+                    node.pop()
+        frontier = next_frontier
+    return None
+
+
+catch_up_moves_cache = LRU(8)
+# Unfinished searches and the time already spent on them, by caching key
+catch_up_searches = LRU(8)
+
+
+def catch_up_moves(
+    virtual_board,
+    physical_fen,
+    max_plies=CATCH_UP_MAX_PLIES,
+    time_limit=CATCH_UP_TIME_LIMIT,
+    total_time_limit=CATCH_UP_TOTAL_TIME_LIMIT,
+):
+    """
+    Return the shortest sequence of moves (uci), up to max_plies, that leads
+    from virtual_board to the physical board placement, or an empty list if
+    there is none.
+
+    Each call searches for at most time_limit seconds. A search that is not
+    finished by then returns an empty list, and is resumed by the next call for
+    the same placement, until it has run for total_time_limit seconds. Only
+    finished (or abandoned) searches are cached.
+    """
+    key = physical_key(physical_fen)
+    if key is None:
+        return []
+    caching_key = (position_key(virtual_board), key, max_plies)
     try:
-        return get_moves_cache[caching_key]
+        return catch_up_moves_cache[caching_key]
     except KeyError:
         pass
 
-    copy_board = virtual_board.copy()
-    moves = list(virtual_board.generate_legal_moves())
-    for move in moves:
-        copy_board.push(move)
-        if physical_fen == copy_board.board_fen():
-            result = [move.uci()]
-            get_moves_cache[caching_key] = result
-            return result
-        copy_board.pop()
-
-    if check_double_moves:
-        for move in moves:
-            copy_board.push(move)
-            legal_moves2 = list(copy_board.generate_legal_moves())
-            for move2 in legal_moves2:
-                copy_board.push(move2)
-                if physical_fen == copy_board.board_fen():
-                    result = [move.uci(), move2.uci()]
-                    get_moves_cache[caching_key] = result
-                    return result
-                copy_board.pop()
-            copy_board.pop()
-
-    result = []
-    get_moves_cache[caching_key] = result
+    try:
+        search, elapsed = catch_up_searches[caching_key]
+    except KeyError:
+        search, elapsed = find_catch_up_moves(virtual_board, key, max_plies), 0
+    start = time.perf_counter()
+    deadline = start + min(time_limit, total_time_limit - elapsed)
+    try:
+        while time.perf_counter() < deadline:
+            next(search)
+    except StopIteration as stop:
+        result = stop.value or []
+    else:
+        elapsed += time.perf_counter() - start
+        if elapsed < total_time_limit:
+            catch_up_searches[caching_key] = (search, elapsed)
+            return []
+        result = []
+    if caching_key in catch_up_searches:
+        del catch_up_searches[caching_key]
+    catch_up_moves_cache[caching_key] = result
     return result
 
 
+def get_lifted_square(virtual_board, physical_fen):
+    """
+    Return square of the piece of the side to move that is missing from the
+    physical board, if that is the only difference (the piece is being moved),
+    otherwise None
+    """
+    key = physical_key(physical_fen)
+    if key is None:
+        return None
+    changed = changed_squares_mask(virtual_board, key)
+    if chess.popcount(changed) != 1:
+        return None
+    if not changed & virtual_board.occupied_co[virtual_board.turn]:
+        return None
+    physical_occupied = key[0] | key[1] | key[2] | key[3] | key[4] | key[5]
+    if changed & physical_occupied:
+        return None
+    return chess.lsb(changed)
+
+
+destinations_cache = LRU(8)
+
+
+def legal_destinations(virtual_board, square):
+    """
+    Return SquareSet of the squares the piece on square can legally move to
+    """
+    destinations_key = position_key(virtual_board)
+    try:
+        destinations = destinations_cache[destinations_key]
+    except KeyError:
+        # Destinations of all pieces of the position
+        destinations = {}
+        for move in virtual_board.generate_legal_moves():
+            destinations[move.from_square] = (
+                destinations.get(move.from_square, 0) | chess.BB_SQUARES[move.to_square]
+            )
+        destinations_cache[destinations_key] = destinations
+    return chess.SquareSet(destinations.get(square, 0))
+
+
+def get_moves(virtual_board, physical_fen, check_double_moves=False, engine="diff"):
+    """
+    Return the moves (uci) that lead from virtual_board to the physical board
+    placement: a single legal move, or, with check_double_moves, two moves
+    (for human games, where both sides may move before the board is read).
+    Returns an empty list if there are none.
+    """
+    return MOVE_ENGINES[engine](virtual_board, physical_fen, check_double_moves)
+
+
 # TODO: Allow double move back for human games
 is_move_back_cache = LRU(8)
 
@@ -0,0 +1,132 @@
+"""
+Latency tracing from board frames to LED output.
+
+usbtool stamps every frame it forwards with the time its bytes were received,
+and the following stages are measured from that time, in milliseconds:
+    queue: frame read by BoardReader (every frame)
+    fen: board change shown by BoardReader
+    move: move recognised in main.py
+    state: next state transition of main.py
+    leds: next LED message sent to usbtool (LedWriter.output_leds)
+The board change (whose frame is the oldest one read in the same update) starts
+a trace, and each later stage is only recorded once per trace. Writes to the
+serial port are measured in the process running usbtool, from the time the LED
+message was received:
+    led_write: LED message written to the board
+
+Recording is a few list operations, so tracing is always on. The histograms are
+logged at exit and, on posix systems, when the process receives SIGUSR1. When
+usbtool runs in a separate process, that process logs led_write itself: when
+it stops, and on SIGUSR1 sent to its own pid.
+"""
+import atexit
+import math
+import signal
+import time
+
+from utils.logger import get_logger
+
+log = get_logger()
+
+
+class LatencyHistogram:
+    """
+    Fixed-bucket histogram of latencies in milliseconds
+    """
+
+    buckets_ms = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, math.inf)
+
+    def __init__(self):
+        self.counts = [0] * len(self.buckets_ms)
+        self.total = 0
+        self.max_ms = 0
+
+    def add(self, latency_ms):
+        for i, bucket in enumerate(self.buckets_ms):
+            if latency_ms <= bucket:
+                self.counts[i] += 1
+                break
+        self.total += 1
+        self.max_ms = max(self.max_ms, latency_ms)
+
+    def percentile(self, fraction):
+        """
+        Return upper bound of the bucket where the given fraction of samples falls
+        """
+        target = fraction * self.total
+        cumulative = 0
+        for bucket, count in zip(self.buckets_ms, self.counts):
+            cumulative += count
+            if count and cumulative >= target:
+                return bucket
+        return 0
+
+    def summary(self):
+        counts = ", ".join(
+            f"<={bucket}ms: {count}"
+            for bucket, count in zip(self.buckets_ms, self.counts)
+            if count
+        )
+        return (
+            f"n={self.total}, p50<={self.percentile(0.5)}ms, "
+            f"p95<={self.percentile(0.95)}ms, max={self.max_ms:.0f}ms ({counts})"
+        )
+
+
+class LatencyTracer:
+    def __init__(self):
+        # Stage -> LatencyHistogram, in the order stages were first recorded
+        self.histograms = {}
+        # Receive time of the frame with the last board change
+        self.origin = None
+        self.traced_stages = set()
+
+    def record(self, stage, origin, now=None):
+        """
+        Record latency of stage since origin (seconds since epoch, or None if
+        unknown)
+        """
+        if origin is None:
+            return
+        if now is None:
+            now = time.time()
+        histogram = self.histograms.get(stage)
+        if histogram is None:
+            histogram = self.histograms[stage] = LatencyHistogram()
+        histogram.add((now - origin) * 1000)
+
+    def start(self, origin):
+        """
+        Start a trace from the receive time of a frame
+        """
+        self.origin = origin
+        self.traced_stages.clear()
+
+    def stage(self, stage, now=None):
+        """
+        Record stage of the current trace, unless it was already recorded
+        """
+        if self.origin is None or stage in self.traced_stages:
+            return
+        self.traced_stages.add(stage)
+        self.record(stage, self.origin, now)
+
+    def dump(self):
+        for stage, histogram in self.histograms.items():
+            log.info(f"Latency of {stage}: {histogram.summary()}")
+
+
+TRACER = LatencyTracer()
+record = TRACER.record
+start = TRACER.start
+stage = TRACER.stage
+dump = TRACER.dump
+
+
+def install():
+    """
+    Log the histograms at exit and on SIGUSR1 (call from the main thread)
+    """
+    atexit.register(dump)
+    if hasattr(signal, "SIGUSR1"):
+        signal.signal(signal.SIGUSR1, lambda signum, frame: dump())
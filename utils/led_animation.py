@@ -0,0 +1,85 @@
+"""
+LED animations played by BoardLink, next to the LED writes (in the usbtool
+thread or process).
+
+Instead of switching the LEDs on and off itself, the main loop submits a
+LedPattern: a sequence of LED frames (8 bytes each) shown in turn for period
+seconds each, until another message replaces it. Patterns go through the same
+queue as plain LED messages (and SharedLedSlot). LedAnimator times the frames
+from the moment the pattern was received, so blinking stays steady however
+often the main loop runs. Frames are written through the LedScheduler, and
+periods are stretched to its minimum interval, as the board would ignore faster
+writes.
+"""
+from collections import namedtuple
+
+# Most frames in a pattern (SharedLedSlot has room for that many)
+MAX_PATTERN_FRAMES = 16
+# Shortest period played, if the LedScheduler has no minimum interval
+MIN_FRAME_PERIOD = 0.02  # seconds
+
+# LED frames (bytes) and seconds each frame is shown
+LedPattern = namedtuple("LedPattern", ("frames", "period"))
+
+
+def blink_pattern(set_leds, flash_leds, period):
+    """
+    Return pattern of set_leds with flash_leds on and off every period seconds
+    (both given as LED byte arrays). It starts with the flashing leds on, so
+    that a flash replaced within its first period is still seen.
+    """
+    full_leds = bytes(
+        set_led | flash_led for set_led, flash_led in zip(set_leds, flash_leds)
+    )
+    blink_leds = bytes(
+        set_led & ~flash_led for set_led, flash_led in zip(set_leds, flash_leds)
+    )
+    return LedPattern((full_leds, blink_leds), period)
+
+
+class LedAnimator:
+    """
+    Keeps track of the frame of the LedPattern being played
+    """
+
+    def __init__(self):
+        self.pattern = None
+        self.period = None
+        self.start_time = None
+        self.frame_index = None
+
+    def play(self, pattern, now, min_period=0):
+        """
+        Start playing pattern, return its first frame
+        """
+        if not 0 < len(pattern.frames) <= MAX_PATTERN_FRAMES:
+            raise ValueError(f"LED pattern has {len(pattern.frames)} frames")
+        self.pattern = pattern
+        self.period = max(pattern.period, min_period, MIN_FRAME_PERIOD)
+        self.start_time = now
+        self.frame_index = 0
+        return pattern.frames[0]
+
+    def stop(self):
+        self.pattern = None
+
+    def next_frame_time(self):
+        """
+        Time the next frame is due, None if no animation is playing
+        """
+        if self.pattern is None or len(self.pattern.frames) < 2:
+            return None
+        return self.start_time + (self.frame_index + 1) * self.period
+
+    def pop_due(self, now):
+        """
+        Return frame that should be shown now, if it is a new one. Frames that
+        were missed are skipped, so that the animation keeps its pace.
+        """
+        if self.pattern is None:
+            return None
+        frame_index = int((now - self.start_time) / self.period)
+        if frame_index <= self.frame_index:
+            return None
+        self.frame_index = frame_index
+        return self.pattern.frames[frame_index % len(self.pattern.frames)]
@@ -0,0 +1,104 @@
+import json
+import math
+import os
+
+from utils import latency
+from utils.latency import LatencyHistogram
+from utils.logger import CERTABO_DATA_PATH, cfg, get_logger
+
+log = get_logger()
+
+DEFAULT_MIN_INTERVAL_MS = 750
+SETTINGS_KEY = "led_interval_ms"
+CERTABO_SETTINGS_FILEPATH = os.path.join(CERTABO_DATA_PATH, "certabo_settings.json")
+
+
+def _load_certabo_settings():
+    try:
+        with open(CERTABO_SETTINGS_FILEPATH, "r", encoding="utf-8") as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {}
+
+
+def load_min_interval_ms():
+    """
+    Minimum interval between LED messages: --led-interval-ms if given, otherwise
+    the value found by dev_tools/led_board_test.py, otherwise the default
+    """
+    if cfg.args.led_interval_ms is not None:
+        return cfg.args.led_interval_ms
+    return _load_certabo_settings().get(SETTINGS_KEY, DEFAULT_MIN_INTERVAL_MS)
+
+
+def save_min_interval_ms(min_interval_ms):
+    settings = _load_certabo_settings()
+    settings[SETTINGS_KEY] = min_interval_ms
+    log.debug(f"Saving {SETTINGS_KEY}={min_interval_ms} to {CERTABO_SETTINGS_FILEPATH}")
+    with open(CERTABO_SETTINGS_FILEPATH, "w", encoding="utf-8") as file:
+        json.dump(settings, file)
+
+
+class LedScheduler:
+    """
+    Decides when LED messages are written to the board.
+
+    Boards ignore LED messages that arrive too shortly after the previous one, so
+    writes are spaced by at least min_interval_ms (which depends on the board
+    firmware, see dev_tools/led_board_test.py). A message is written immediately
+    if the line has been idle for that long. Otherwise it waits, and any newer
+    message submitted in the meantime replaces it, so bursts are coalesced into
+    the latest state. The time from the first pending request to the serial
+    write is stored in a latency histogram.
+    """
+
+    def __init__(self, min_interval_ms=750):
+        self.min_interval = min_interval_ms / 1000
+        self.pending = None
+        self.pending_since = None
+        self.last_write_time = -math.inf
+        self.last_written = None
+        self.latency = LatencyHistogram()
+
+    def submit(self, message, now):
+        if self.pending_since is None:
+            self.pending_since = now
+        self.pending = message
+
+    def time_until_due(self, now):
+        """
+        Seconds until the pending message can be written, None if there is none
+        """
+        if self.pending is None:
+            return None
+        return max(0, self.last_write_time + self.min_interval - now)
+
+    def pop_due(self, now):
+        """
+        Return message that should be written now, if any
+        """
+        if self.pending is None or now < self.last_write_time + self.min_interval:
+            return None
+
+        message = self.pending
+        self.pending = None
+        # Burst ended in the state that is already shown
+        if message == self.last_written:
+            self.pending_since = None
+            return None
+        return message
+
+    def mark_written(self, message, now):
+        self.latency.add((now - self.pending_since) * 1000)
+        latency.record("led_write", self.pending_since, now)
+        self.pending_since = None
+        self.last_write_time = now
+        self.last_written = message
+
+    def reconnected(self, now):
+        """
+        Board state is unknown after a reconnection: send last message again
+        """
+        if self.pending is None and self.last_written is not None:
+            self.submit(self.last_written, now)
+        self.last_written = None
@@ -18,6 +18,12 @@ except ImportError:
     cfg.args = SimpleNamespace()
     cfg.args.usbport = None
     cfg.args.port_not_strict = True
+    cfg.args.polling_io = False
+    cfg.args.led_interval_ms = None
+    cfg.args.record = None
+    cfg.args.reading_filter = "majority"
+    cfg.args.nearest_codes = False
+    cfg.args.reading_stats = None
 
 CERTABO_DATA_PATH = appdirs.user_data_dir("GUI", "Certabo")
 
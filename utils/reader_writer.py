@@ -1,13 +1,21 @@
-import os
-import pickle
 import queue
 import time
 from collections import Counter, deque
 
 import chess
-
-from utils import usbtool
-from utils.logger import CERTABO_DATA_PATH, cfg, get_logger
+from lru import LRU
+
+from utils import get_moves, latency, usbtool
+from utils.calibration import (
+    CALIBRATION_ORDER,
+    CalibrationError,
+    CalibrationIndex,
+    calibration_filepath,
+)
+from utils.led_animation import LedPattern, blink_pattern
+from utils.logger import cfg, get_logger
+from utils.reading_filter import DebounceFilter
+from utils.reading_stats import ReadingStats
 
 FEN_SPRITE_MAPPING = {
     "b": "black_bishop",
@@ -24,20 +32,101 @@ FEN_SPRITE_MAPPING = {
     "R": "white_rook",
 }
 COLUMNS_LETTERS = "a", "b", "c", "d", "e", "f", "g", "h"
-COLUMNS_LETTERS_REVERSED = tuple(reversed(COLUMNS_LETTERS))
+ALL_CELLS = range(64)
+SQUARE_INDEXES = {name: square for square, name in enumerate(chess.SQUARE_NAMES)}
+# LED messages last converted to bytes, by (message, rotate180)
+LED_MESSAGES_CACHE_SIZE = 64
+# Seconds between logs of codes matched despite a misread byte
+MATCH_STATS_INTERVAL = 60
+# Seconds without any board frame before a warning is logged
+NO_READING_WARNING = 5
 
 
 log = get_logger()
 
 
+def _led_bit(row, bit):
+    """
+    Return bit of a led in the 8 LED bytes read as a big endian 64-bit integer
+    """
+    return 1 << (8 * (7 - row) + bit)
+
+
+# Bit of each square (python-chess numbering) in the LED frame, in normal and
+# rotated orientation: row 0 is the first byte sent (rank 8 unless rotated)
+# and bit 0 is file a (h if rotated)
+LED_SQUARE_BITS = (
+    tuple(
+        _led_bit(7 - chess.square_rank(square), chess.square_file(square))
+        for square in chess.SQUARES
+    ),
+    tuple(
+        _led_bit(chess.square_rank(square), 7 - chess.square_file(square))
+        for square in chess.SQUARES
+    ),
+)
+
+
+class _VoteTable(dict):
+    """
+    Memoised majority vote: maps the pieces read in a square over the history
+    (in history slot order) to the piece that is shown.
+
+    The most common piece wins and ties go to the one that appears first, as
+    with Counter.most_common. Unknown codes ("?") only win if all samples agree,
+    otherwise the square is considered empty.
+    """
+
+    def __init__(self, depth):
+        super().__init__()
+        self.depth = depth
+
+    def __missing__(self, votes):
+        winner = max(votes, key=votes.count)
+        # If unknown readings are not reliable, consider them empty squares
+        if winner == "?" and votes.count("?") < self.depth:
+            winner = "."
+        self[votes] = winner
+        return winner
+
+
+class _FenRowTable(dict):
+    """
+    Memoised conversion of a row of 8 pieces to FEN, without and with unknown
+    ("?") pieces
+    """
+
+    def __missing__(self, row):
+        fen_rows = []
+        for unknown in (".?", "."):
+            fen_row = ""
+            empty = 0
+            for piece in row:
+                if piece in unknown:
+                    empty += 1
+                else:
+                    if empty > 0:
+                        fen_row += str(empty)
+                        empty = 0
+                    fen_row += piece
+            if empty > 0:
+                fen_row += str(empty)
+            fen_rows.append(fen_row)
+        self[row] = fen_rows = tuple(fen_rows)
+        return fen_rows
+
+
 class BoardReader:
-    def __init__(self, portname):
+    def __init__(self, portname, reading_filter=None):
         self.queue = usbtool.QUEUE_FROM_USBTOOL
 
         self.data_history_depth = 3
         self.data_history_pointer = 0
         self.data_history_counter = 0
-        self.data_history = [""] * self.data_history_depth
+        self.new_samples = 0
+        self.data_history = [b""] * self.data_history_depth
+        # Pieces read in each frame of data_history
+        self.pieces_history = [None] * self.data_history_depth
         self.last_update_time = time.time()
 
         self.calibration_samples_n = 15
@@ -46,92 +135,113 @@ class BoardReader:
 
         self.board_fen = chess.Board().board_fen()
         self.board_fen_missing = self.board_fen
+        # Piece shown in each cell (a8 first, h1 last) and FEN of each row
+        self.board = [
+            "." if piece is None else piece.symbol()
+            for piece in map(chess.Board().piece_at, chess.SQUARES_180)
+        ]
+        self.fen_rows = [(row, row) for row in self.board_fen.split("/")]
+        # Squares (python-chess numbering) that changed in the last update
+        self.changed_squares = []
+        if reading_filter is None:
+            reading_filter = cfg.args.reading_filter
+        # Majority vote over data_history is used without a debounce filter
+        self.debounce_filter = (
+            DebounceFilter(self.board) if reading_filter == "debounce" else None
+        )
         self.counter = Counter()
+        self.frame_pieces_cache = {}
+        # Match codes with a misread byte to the closest calibrated piece
+        self.nearest_codes = cfg.args.nearest_codes
+        self.match_stats_time = time.time()
+        self.vote_table = _VoteTable(self.data_history_depth)
+        self.fen_row_table = _FenRowTable()
+        self.reading_stats = ReadingStats(time.time(), dump_path=cfg.args.reading_stats)
+        self.no_reading_warned = False
 
         self.needs_calibration = False
-        self.code_mapping_order = (
-            "p",
-            "r",
-            "n",
-            "b",
-            "k",
-            "q",
-            "P",
-            "R",
-            "N",
-            "B",
-            "K",
-            "Q",
-        )
-        self.calibration_file = (
-            f'calibration-{portname.replace("/","").replace(":","")}.bin'
-        )
-        self.calibration_filepath = os.path.join(
-            CERTABO_DATA_PATH, self.calibration_file
-        )
-        self.code_mapping = {}
+        self.code_mapping_order = tuple(CALIBRATION_ORDER)
+        self.calibration_filepath = calibration_filepath(portname)
+        self.calibration_index = CalibrationIndex()
+        self.code_mapping = self.calibration_index.pieces
         self.load_piece_codes()
         self.cell_slice_mapping = [slice(cell * 5, cell * 5 + 5) for cell in range(64)]
 
     def load_piece_codes(self):
-        mapping = {}
-        if not os.path.exists(self.calibration_filepath):
-            log.debug("No calibration file detected: creating new file")
+        log.debug(f"Loading calibration file: {self.calibration_filepath}")
+        try:
+            self.calibration_index = CalibrationIndex.load(self.calibration_filepath)
+        except FileNotFoundError:
+            log.debug("No calibration file detected")
+            self.calibration_index = CalibrationIndex()
+        except CalibrationError as exc:
+            log.warning(f"Could not load calibration: {exc}")
+            self.calibration_index = CalibrationIndex()
+        if not self.calibration_index:
             self.needs_calibration = True
-            with open(self.calibration_filepath, "wb") as file:
-                pickle.dump({}, file)
+        self.code_mapping = self.calibration_index.pieces
 
-        log.debug(f"Loading calibration file: {self.calibration_filepath}")
-        with open(self.calibration_filepath, "rb") as file:
-            data = pickle.load(file)
-        for letter, piece in zip(self.code_mapping_order, data):
-            for piece_variation in piece:
-                key = tuple(str(c) for c in piece_variation)
-                mapping[key] = letter
-        mapping[("0", "0", "0", "0", "0")] = "."
-        self.code_mapping = mapping
-
-    def data_to_fen(self):
-        data_history = [data[1:].split(" ") for data in self.data_history if data]
-        # Get board pieces from USB data
-        board = []
-        for cell_range in self.cell_slice_mapping:
-            sample = (
-                self.code_mapping.get(tuple(sample[cell_range]), "?")
-                for sample in data_history
-            )
-            self.counter.update(sample)
-            most_common_code, most_common_counts = self.counter.most_common(1)[0]
-            # If unknown readings are not reliable, consider them empty squares
-            if most_common_code == "?" and most_common_counts < self.data_history_depth:
-                most_common_code = "."
+        # Pieces have to be read again with the new codes
+        self.frame_pieces_cache.clear()
+        self.pieces_history = [
+            self.frame_to_pieces(data) if data else None for data in self.data_history
+        ]
+        # Candidates and error rates were read with the old codes
+        if self.debounce_filter is not None:
+            self.debounce_filter.reset()
 
-            board.append(most_common_code)
-            self.counter.clear()
+    def frame_to_pieces(self, data):
+        """
+        Return tuple with the piece read in each cell ("?" for unknown codes)
+        """
+        try:
+            return self.frame_pieces_cache[data]
+        except KeyError:
+            pass
+        if len(self.frame_pieces_cache) >= 256:
+            self.frame_pieces_cache.clear()
+        pieces = tuple(
+            self.calibration_index.frame_pieces(data, nearest=self.nearest_codes)
+        )
+        self.frame_pieces_cache[data] = pieces
+        return pieces
+
+    def data_to_fen(self, cells=ALL_CELLS):
+        """
+        Vote again the pieces of the given cells, and update the FEN if any of
+        them changed. Returns the cells that changed.
+        """
+        pieces_history = [pieces for pieces in self.pieces_history if pieces]
+        vote = self.vote_table.__getitem__
+        board = self.board
+
+        changed_cells = []
+        for cell in cells:
+            # Most common piece of the square over the history (a list is
+            # faster to build than a generator in this hot loop)
+            votes = [pieces[cell] for pieces in pieces_history]
+            winner = vote(tuple(votes))
+            if winner != board[cell]:
+                board[cell] = winner
+                changed_cells.append(cell)
+        if not changed_cells:
+            if cfg.DEBUG_READING:
+                log.debug("UsbReader: Computing FEN -> board not changed")
+            return changed_cells
 
-        def board_to_fen(board, ignore_unknown):
-            # Convert to FEN
-            fen_string = ""
-            for row in range(8):
-                empty = 0
-                for col in range(8):
-                    piece = board[row * 8 + col]
-
-                    if piece == "." or (ignore_unknown and piece == "?"):
-                        empty += 1
-                    else:
-                        if empty > 0:
-                            fen_string += str(empty)
-                            empty = 0
-                        fen_string += piece
-                if empty > 0:
-                    fen_string += str(empty)
-                if row < 7:
-                    fen_string += r"/"
-            return fen_string
-
-        fen_string_missing = board_to_fen(board, ignore_unknown=False)
-        fen_string = board_to_fen(board, ignore_unknown=True)
+        self.board_to_fen(changed_cells)
+        return changed_cells
+
+    def board_to_fen(self, changed_cells):
+        """
+        Update the FEN after the pieces of changed_cells changed in self.board
+        """
+        board = self.board
+        fen_rows = self.fen_rows
+        for row in {cell // 8 for cell in changed_cells}:
+            fen_rows[row] = self.fen_row_table[tuple(board[row * 8 : row * 8 + 8])]
+        fen_string_missing = "/".join([row[1] for row in fen_rows])
+        fen_string = "/".join([row[0] for row in fen_rows])
 
         if cfg.DEBUG_READING:
             if self.board_fen != fen_string:
@@ -147,15 +257,89 @@ class BoardReader:
         self.board_fen = fen_string
         self.board_fen_missing = fen_string_missing
 
-    def update(self):
-        # TODO: Add timer and log when board cannot be read for too long
-        changed = False
-        new_data = False
+    def log_match_stats(self):
+        """
+        Log codes matched despite a misread byte since the last call. A piece
+        that keeps showing up has a chip that may be failing.
+        """
+        near_matches, ambiguous_matches = self.calibration_index.pop_match_stats()
+        for piece, code, position, count in near_matches:
+            log.info(
+                f"UsbReader: {piece} {code} read with byte {position} wrong "
+                f"in {count} distinct frames"
+            )
+        if ambiguous_matches:
+            log.info(
+                f"UsbReader: {ambiguous_matches} codes close to several pieces "
+                f"were left unknown"
+            )
+        self.match_stats_time = time.time()
+
+    def check_reading(self, new_frames, now):
+        """
+        Log when the board cannot be read for too long, and when it is read again
+        """
+        last_frame_time = self.reading_stats.last_frame_time
+        if last_frame_time is None:
+            last_frame_time = self.reading_stats.start_time
+        if new_frames:
+            if self.no_reading_warned:
+                log.info(
+                    f"UsbReader: board read again after {now - last_frame_time:.1f}s"
+                )
+                self.no_reading_warned = False
+        elif not self.no_reading_warned and now - last_frame_time > NO_READING_WARNING:
+            log.warning(f"UsbReader: board not read for {now - last_frame_time:.1f}s")
+            self.no_reading_warned = True
+
+    def get_reading_stats(self):
+        """
+        Return board reading quality statistics (see utils.reading_stats)
+        """
+        return self.reading_stats.stats(self.calibration_index, time.time())
+
+    def get_new_frames(self):
+        """
+        Return frames received from usbtool since last update
+        """
+        # Shared memory transport gives direct access to the most recent frames
+        get_latest = getattr(self.queue, "get_latest", None)
+        if get_latest is not None:
+            return get_latest(self.data_history_depth)
+
+        frames = []
         while True:
             try:
-                data = self.queue.get_nowait()
-                new_data = True
+                frames.append(self.queue.get_nowait())
+            except queue.Empty:
+                return frames
 
+    def update(self):
+        """
+        Read new frames and return the squares (python-chess numbering) whose
+        piece changed. They are also kept in changed_squares.
+        """
+        dirty_cells = set()
+        debounced_cells = set()
+        board_before = list(self.board)
+        now = time.time()
+        new_frames = self.get_new_frames()
+        self.check_reading(new_frames, now)
+        self.reading_stats.add(new_frames, self.calibration_index, now)
+        # Time of the frame that changed the board, where latency traces start
+        change_time = new_frames[-1].time if new_frames else None
+        for frame in new_frames:
+            latency.record("queue", frame.time, now)
+            data = frame.codes
+            if self.debounce_filter is not None:
+                frame_cells = self.debounce_filter.read(
+                    self.frame_to_pieces(data), frame.repeats
+                )
+                if frame_cells:
+                    debounced_cells.update(frame_cells)
+                    change_time = frame.time
+            # Usbtool only reports how many times an unchanged frame was read
+            for _ in range(min(frame.repeats, self.data_history_depth)):
                 # Check if data stream is different than any other saved in the history
                 for _ in range(self.data_history_depth):
 
@@ -167,19 +351,54 @@ class BoardReader:
                         # If it is replace it, and break out of loop to avoid
                         # rewriting more than one entry in the history
                         self.data_history[self.data_history_pointer] = data
-                        changed = True
+                        old_pieces = self.pieces_history[self.data_history_pointer]
+                        new_pieces = self.frame_to_pieces(data)
+                        self.pieces_history[self.data_history_pointer] = new_pieces
+                        # Only cells read differently can change their vote
+                        if old_pieces is None:
+                            dirty_cells.update(ALL_CELLS)
+                        elif self.debounce_filter is None:
+                            dirty_cells.update(
+                                cell
+                                for cell, old, new in zip(
+                                    ALL_CELLS, old_pieces, new_pieces
+                                )
+                                if old != new
+                            )
                         break
 
-            except queue.Empty:
-                if new_data:
-                    # This is used for calibration, to know when a new sample was obtained
-                    self.data_history_counter = (
-                        self.data_history_counter + 1
-                    ) % 64  # Limit number range to 64 values
-
-                if changed:
-                    self.data_to_fen()
-                return
+        self.new_samples = sum(frame.repeats for frame in new_frames)
+        if (
+            self.nearest_codes
+            and new_frames
+            and time.time() > self.match_stats_time + MATCH_STATS_INTERVAL
+        ):
+            self.log_match_stats()
+        if new_frames:
+            # This is used for calibration, to know when a new sample was obtained
+            self.data_history_counter = (
+                self.data_history_counter + 1
+            ) % 64  # Limit number range to 64 values
+
+        if self.debounce_filter is not None:
+            # A cell may have changed back within the frames read
+            changed_cells = [
+                cell
+                for cell in debounced_cells
+                if self.board[cell] != board_before[cell]
+            ]
+            if changed_cells:
+                self.board_to_fen(changed_cells)
+        elif dirty_cells:
+            changed_cells = self.data_to_fen(dirty_cells)
+        else:
+            changed_cells = []
+        if changed_cells:
+            latency.start(change_time)
+            latency.stage("fen")
+        # Cells are numbered from a8, python-chess squares from a1
+        self.changed_squares = sorted(cell ^ 56 for cell in changed_cells)
+        return self.changed_squares
 
     def read_board(self, rotate180=False, update=True):
         if update:
@@ -191,9 +410,7 @@ class BoardReader:
 
     def do_calibration(self, new_setup, verbose=False):
         # STEP 1) Combine data and find most common codes per cell
-        data_history = [
-            data[1:].split(" ") for data in self.calibration_samples if data is not None
-        ]
+        data_history = [data for data in self.calibration_samples if data]
 
         board_reading = []
         for n_cell, cell_range in enumerate(self.cell_slice_mapping):
@@ -204,9 +421,9 @@ class BoardReader:
                 log.debug(f"\n    {cell_id} samples:")
 
             for sample in data_history:
-                cell_readings.append(tuple(sample[cell_range]))
+                cell_readings.append(sample[cell_range])
                 if verbose:
-                    log.debug(sample[cell_range])
+                    log.debug(list(sample[cell_range]))
 
             self.counter.update(cell_readings)
             most_common = self.counter.most_common(1)[0][0]
@@ -214,9 +431,7 @@ class BoardReader:
 
             board_reading.extend(most_common)
             if verbose:
-                log.debug(f"\n   Final code for {cell_id}: {most_common}")
-
-        board_reading = [int(val) for val in board_reading]
+                log.debug(f"\n   Final code for {cell_id}: {list(most_common)}")
 
         # STEP 2) Save codes obtained from board_reading
 
@@ -244,13 +459,8 @@ class BoardReader:
 
         # Populate with old info if doing "add_piece"
         if not new_setup:
-            # Convert code_mapping (code -> piece) to calibration_mapping (piece -> code)
-            for code, piece in self.code_mapping.items():
-                # Skip empty square
-                if piece == ".":
-                    continue
-                code_int_list = [int(num) for num in code]
-                calibration_mapping[piece].append(code_int_list)
+            for piece in calibration_mapping:
+                calibration_mapping[piece] = self.calibration_index.piece_codes(piece)
 
         for i in range(8):
             add_mapping("p", 8 + i)
@@ -280,8 +490,7 @@ class BoardReader:
         add_mapping("K", 60)
 
         calibration_data = [calibration_mapping[key] for key in self.code_mapping_order]
-        with open(self.calibration_filepath, "wb") as file:
-            pickle.dump(calibration_data, file)
+        CalibrationIndex(calibration_data).save(self.calibration_filepath)
 
         if new_setup:
             log.debug("Calibration: New mapping obtained:")
@@ -291,9 +500,11 @@ class BoardReader:
     def calibration(self, new_setup, verbose=False):
         # If there was a new sample since last call, save it to calibration
         if self.calibration_data_history_counter != self.data_history_counter:
-            self.calibration_samples.append(
-                self.data_history[self.data_history_pointer]
-            )
+            # Repeated readings of the same frame count as separate samples
+            for _ in range(min(self.new_samples, self.calibration_samples_n)):
+                self.calibration_samples.append(
+                    self.data_history[self.data_history_pointer]
+                )
             self.calibration_data_history_counter = self.data_history_counter
 
         if len(self.calibration_samples) >= self.calibration_samples_n:
@@ -304,7 +515,8 @@ class BoardReader:
             # Reset calibration readings
             self.calibration_samples.clear()
 
-            # Update reading
+            # Update reading (the debounce filter, reset by load_piece_codes,
+            # goes on from the pieces voted here)
             self.load_piece_codes()
             self.data_to_fen()
             log.debug("Calibration: completed successfully")
@@ -328,15 +540,14 @@ class LedWriter:
             "setup": [255, 255, 8, 0, 0, 8, 255, 255],
         }
 
+        self.led_messages = LRU(LED_MESSAGES_CACHE_SIZE)
+
         self.last_message = None
         self.last_flash_message = None
         self.last_leds = [0] * 8
-        self.full_leds = None
-        self.blink_leds = None
+        self.flash_pattern = None
 
         self.flash_frequency = 1  # seconds
-        self.flash_timer = 0
-        self.counter = 0
 
         self.last_misplaced_comparison = None
         self.last_misplaced_message = None
@@ -356,41 +567,35 @@ class LedWriter:
         # New message
         if self.last_flash_message != message:
             self.last_flash_message = message
-            self.flash_timer = 0
-            self.counter = 0
+            self.flash_pattern = None
             if cfg.DEBUG_LED:
                 log.debug(f"LedManager: New Flash - {message}")
 
-        # Flash message on/off every 1 second
-        if time.time() >= self.flash_timer:
-            self.flash_timer = time.time() + self.flash_frequency
-            self.counter += 1
-
+        # Flash message on/off every 1 second (played by usbtool)
         flash_leds = self.message_to_bytes(message, rotate180)
-        leds = (flash_leds, self.default_messages["none"])[self.counter % 2]
-        self.output_leds(leds)
+        self.output_leds(
+            blink_pattern(
+                self.default_messages["none"], flash_leds, self.flash_frequency
+            )
+        )
 
     def set_and_flash_leds(
         self, set_message="none", flash_message="none", rotate180=False
     ):
         # New Message
-        if self.last_flash_message != flash_message or self.last_message != set_message:
+        if (
+            self.last_flash_message != flash_message
+            or self.last_message != set_message
+            or self.flash_pattern is None
+        ):
             self.last_message = set_message
             self.last_flash_message = flash_message
-            self.flash_timer = 0
-            self.counter = 0
-
-            set_leds = self.message_to_bytes(set_message, rotate180)
-            flash_leds = self.message_to_bytes(flash_message, rotate180)
-            self.full_leds = [0] * 8
-            self.blink_leds = [0] * 8
-            for i in range(8):
-                self.full_leds[i] = (
-                    set_leds[i] | flash_leds[i]
-                )  # bitwise or -> Gathers all squares
-                self.blink_leds[i] = (
-                    self.full_leds[i] ^ flash_leds[i]
-                )  # bitwise xor-> Removes the flashing squares
+
+            self.flash_pattern = blink_pattern(
+                self.message_to_bytes(set_message, rotate180),
+                self.message_to_bytes(flash_message, rotate180),
+                self.flash_frequency,
+            )
 
             if cfg.DEBUG_LED:
                 log.debug(
@@ -399,13 +604,8 @@ class LedWriter:
                     f"\t|flash={flash_message}"
                 )
 
-        # Flash message on/off every 1 second
-        if time.time() >= self.flash_timer:
-            self.flash_timer = time.time() + self.flash_frequency
-            self.counter += 1
-
-        leds = (self.full_leds, self.blink_leds)[self.counter % 2]
-        self.output_leds(leds)
+        # Flash message on/off every 1 second (played by usbtool)
+        self.output_leds(self.flash_pattern)
 
     def message_to_bytes(self, message, rotate180=False):
         """
@@ -413,71 +613,76 @@ class LedWriter:
         If text is given try to retrieve default message,
         otherwise assume square information was passed
         """
+        if isinstance(message, list):
+            message = tuple(message)
+        caching_key = (message, rotate180)
         try:
-            return self.default_messages[message]
-        except (KeyError, TypeError):
+            return self.led_messages[caching_key]
+        except KeyError:
+            pass
+        except TypeError:
+            # Unhashable messages (e.g., SquareSet) are cheap to convert
             return self.squares2led(message, rotate180)
 
+        try:
+            leds = self.default_messages[message]
+        except KeyError:
+            leds = self.squares2led(message, rotate180)
+        self.led_messages[caching_key] = leds
+        return leds
+
     def output_leds(self, leds):
         """
-        Outputs a LED byte array to usbtool
+        Outputs a LED byte array or a LedPattern to usbtool
         """
         if leds != self.last_leds:
             if cfg.DEBUG_LED:
                 log.debug(f"LedManager: sending to usbtool - {leds}, {len(leds)}")
             self.last_leds = leds
-            self.queue_to_usbtool.put(bytes(leds))
-            time.sleep(0.001)
+            if isinstance(leds, LedPattern):
+                self.queue_to_usbtool.put(leds)
+            else:
+                self.queue_to_usbtool.put(bytes(leds))
+            latency.stage("leds")
+
+    @staticmethod
+    def mask2led(mask, rotate180=False):
+        """
+        Converts a bitboard of squares (python-chess numbering) to Certabo
+        binary led encoding
+        """
+        if rotate180:
+            mask = chess.flip_vertical(chess.flip_horizontal(mask))
+        # Bytes are the ranks from 8 to 1, bits the files from a to h
+        return list(mask.to_bytes(8, "big"))
 
     @staticmethod
     def squares2led(squares, rotate180=False):
         """
-        Converts list of squares to Certabo binary led encoding
+        Converts squares to Certabo binary led encoding
         e.g., ['e2', 'e4'] = [0, 0, 0, 0, 16, 0, 16, 0] -> '\x00\x00\x00\x00\x10\x00\x10\x00'
 
+        Squares are names or python-chess squares, in any iterable or a SquareSet.
         Accepts alternative string input (eg., 'e2' or even move string 'e2e4')
         Does not recognize move string inside list (e.g., ['e2e4'])
         """
-
-        def _square2certabo(square, rotate180=False):
-            """
-            Converts a chess position code (e.g., e2) to the respective Certabo
-            led code (e.g., led[6] = 16)
-            """
-            if rotate180:
-                col = COLUMNS_LETTERS_REVERSED.index(square[0])
-                row = 9 - int(square[1])
-            else:
-                col = COLUMNS_LETTERS.index(square[0])
-                row = int(square[1])
-
-            return 8 - row, 2 ** col
+        if isinstance(squares, chess.SquareSet):
+            return LedWriter.mask2led(int(squares), rotate180)
 
         # If single string was given assume a single square or move was passed
         if isinstance(squares, str):
-            # Assume single square and force tuple
             if len(squares) < 4:
-                led_positions = (_square2certabo(squares, rotate180),)
-            # Assume move
+                squares = (squares,)
             else:
-                led_positions = (
-                    _square2certabo(squares[i : i + 2], rotate180) for i in (0, 2)
-                )
-        # Otherwise assume a list of squares was given
-        else:
-            # If list contains only one item, force tuple
-            if len(squares) == 1:
-                led_positions = (_square2certabo(squares[0], rotate180),)
-            else:
-                led_positions = (
-                    _square2certabo(square, rotate180) for square in set(squares)
-                )
+                squares = (squares[0:2], squares[2:4])
 
-        leds = [0] * 8
-        for row, col in led_positions:
-            leds[row] += col
-
-        return leds
+        square_bits = LED_SQUARE_BITS[rotate180]
+        mask = 0
+        for square in squares:
+            if isinstance(square, str):
+                square = SQUARE_INDEXES[square]
+            mask |= square_bits[square]
+        return list(mask.to_bytes(8, "big"))
 
     def highlight_misplaced_pieces(
         self,
@@ -493,10 +698,14 @@ class LedWriter:
         seconds before actually highlighting the leds. If leds are highlighted
         it returns True, otherwise returns None
         """
-        boards_fens = physical_board_fen + virtual_board.fen()
+        physical_key = get_moves.physical_key(physical_board_fen)
+        if physical_key is None:
+            log.error("Corrupt FEN from physical board")
+            return None
+        comparison = (get_moves.placement_key(virtual_board), physical_key)
 
         # If this comparison was already performed and enough time passed: highlight leds
-        if boards_fens == self.last_misplaced_comparison:
+        if comparison == self.last_misplaced_comparison:
             if time.time() - self.misplaced_clock > self.misplaced_wait_time:
                 if not suppress_leds:
                     self.set_leds(self.last_misplaced_message, rotate180)
@@ -506,30 +715,25 @@ class LedWriter:
 
         # Otherwise find which leds should be highlighted
         else:
-            try:
-                temp_board = chess.Board()
-                temp_board.set_board_fen(physical_board_fen)
-            except ValueError:
-                log.error("Corrupt FEN from physical board")
-            else:  # No Exception
-                diffs = [
-                    chess.SQUARE_NAMES[square]
-                    for square in range(64)
-                    if virtual_board.piece_at(square) != temp_board.piece_at(square)
-                ]
-                if diffs:
-                    if cfg.DEBUG_LED:
-                        log.debug(f"LedManager: found new board differences: {diffs}")
-                        if not display_leds_immediately:
-                            log.debug(
-                                f"LedManager: waiting {self.misplaced_wait_time} "
-                                f"seconds to highlight them"
-                            )
+            diffs = chess.SquareSet(
+                get_moves.changed_squares_mask(virtual_board, physical_key)
+            )
+            if diffs:
+                if cfg.DEBUG_LED:
+                    log.debug(
+                        f"LedManager: found new board differences: "
+                        f"{[chess.square_name(square) for square in diffs]}"
+                    )
+                    if not display_leds_immediately:
+                        log.debug(
+                            f"LedManager: waiting {self.misplaced_wait_time} "
+                            f"seconds to highlight them"
+                        )
 
-                    self.last_misplaced_comparison = boards_fens
-                    self.last_misplaced_message = diffs
-                    self.misplaced_clock = time.time()
+                self.last_misplaced_comparison = comparison
+                self.last_misplaced_message = diffs
+                self.misplaced_clock = time.time()
 
-                    if display_leds_immediately:
-                        self.set_leds(self.last_misplaced_message, rotate180)
+                if display_leds_immediately:
+                    self.set_leds(self.last_misplaced_message, rotate180)
         return None
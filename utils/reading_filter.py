@@ -0,0 +1,151 @@
+"""
+Per-square debounce of board readings, used by BoardReader instead of the
+majority vote over the last frames with --reading-filter debounce.
+
+A square shows a new piece once that piece was read there a number of times in
+a row. That number adapts to each square: it is the smallest one for which a
+wrong reading is unlikely to repeat as many times, given the rate of wrong
+readings seen on the square. Clean squares change after a single read, noisy
+ones (e.g. a badly calibrated piece) wait for more confirmations. Wrong
+readings are rare on any single square, so the rate of the whole board is used
+as a lower bound.
+"""
+import math
+
+MIN_READS = 1
+MAX_READS = 6
+# Rate of wrong readings assumed for the board before any frame was read
+ERROR_RATE_PRIOR = 0.01
+# Weight of each read in the (exponentially averaged) rate of wrong readings of
+# a square, and of each frame in that of the whole board
+ERROR_RATE_ALPHA = 0.005
+BOARD_ERROR_RATE_ALPHA = 0.01
+# Accepted probability of showing a wrong reading, per frame
+FALSE_CHANGE_TARGET = 1e-3
+
+ALL_CELLS = range(64)
+
+
+def reads_needed(error_rate):
+    """
+    Return the number of consistent reads needed before a square changes
+    """
+    if error_rate >= 1:
+        return MAX_READS
+    # Any of the 64 squares may show a wrong reading
+    target = FALSE_CHANGE_TARGET / 64
+    if error_rate <= target:
+        return MIN_READS
+    reads = math.ceil(math.log(target) / math.log(error_rate))
+    return min(MAX_READS, max(MIN_READS, reads))
+
+
+class DebounceFilter:
+    def __init__(self, board):
+        # Pieces shown in each cell (a8 first, h1 last), updated in place
+        self.board = board
+        self.reset()
+
+    def reset(self):
+        """
+        Forget candidates and error rates (e.g. after a new calibration), and
+        keep showing the pieces currently in board
+        """
+        # Piece read differently from the one shown, and how many times in a row
+        self.candidate = [None] * 64
+        self.candidate_reads = [0] * 64
+        self.pending = set()
+
+        # Squares are only known to be noisier than the rest of the board once
+        # wrong readings were seen there
+        self.error_rate = [0.0] * 64
+        self.reads_needed = [MIN_READS] * 64
+        # Total number of reads, and its value when the error rate of each
+        # cell was last updated (reads in between were all correct)
+        self.reads = 0
+        self.error_rate_reads = [0] * 64
+        # Wrong readings per cell read, over the whole board
+        self.board_error_rate = ERROR_RATE_PRIOR
+        self.board_errors = 0
+        # Piece shown before the last change of each cell, and when it changed
+        self.previous_piece = [None] * 64
+        self.change_reads = [0] * 64
+
+    def _learn(self, cell, errors):
+        """
+        Update the error rate of a cell, knowing that the last `errors` reads
+        were wrong
+        """
+        self.board_errors += errors
+        correct = max(0, self.reads - self.error_rate_reads[cell] - errors)
+        keep = 1 - ERROR_RATE_ALPHA
+        error_rate = self.error_rate[cell] * keep ** correct
+        error_rate = 1 - (1 - error_rate) * keep ** errors
+        self.error_rate[cell] = error_rate
+        self.error_rate_reads[cell] = self.reads
+        self.reads_needed[cell] = reads_needed(error_rate)
+
+    def _drop_candidate(self, cell):
+        self.candidate[cell] = None
+        self.candidate_reads[cell] = 0
+        self.pending.discard(cell)
+
+    def read(self, pieces, repeats=1):
+        """
+        Filter the pieces read in a frame (repeats: number of times it was
+        read). Returns the cells whose shown piece changed.
+        """
+        board = self.board
+        candidate = self.candidate
+        candidate_reads = self.candidate_reads
+        changed_cells = []
+        for _ in range(min(repeats, MAX_READS)):
+            self.reads += 1
+            self.board_error_rate += BOARD_ERROR_RATE_ALPHA * (
+                self.board_errors / 64 - self.board_error_rate
+            )
+            self.board_errors = 0
+            board_reads_needed = reads_needed(self.board_error_rate)
+            cells = self.pending.union(
+                [
+                    cell
+                    for cell, shown, piece in zip(ALL_CELLS, board, pieces)
+                    if shown != piece
+                ]
+            )
+            for cell in cells:
+                piece = pieces[cell]
+                if piece == board[cell]:
+                    # Reading went back to the piece shown: candidate was noise
+                    self._learn(cell, errors=candidate_reads[cell])
+                    self._drop_candidate(cell)
+                    continue
+
+                if piece == candidate[cell]:
+                    candidate_reads[cell] += 1
+                else:
+                    # Reads since the error rate was updated were either correct
+                    # or, if there was another candidate, wrong
+                    self._learn(cell, errors=candidate_reads[cell])
+                    candidate[cell] = piece
+                    candidate_reads[cell] = 1
+                    self.pending.add(cell)
+
+                if candidate_reads[cell] >= max(
+                    self.reads_needed[cell], board_reads_needed
+                ):
+                    if (
+                        piece == self.previous_piece[cell]
+                        and self.reads - self.change_reads[cell] <= MAX_READS
+                    ):
+                        # Quickly changed back: the last change was noise
+                        errors = self.reads - self.change_reads[cell]
+                    else:
+                        errors = 0
+                    self._learn(cell, errors)
+                    self.previous_piece[cell] = board[cell]
+                    self.change_reads[cell] = self.reads
+                    board[cell] = piece
+                    changed_cells.append(cell)
+                    self._drop_candidate(cell)
+        return changed_cells
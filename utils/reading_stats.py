@@ -0,0 +1,174 @@
+"""
+Board reading quality counters kept by BoardReader: board readings and frames
+per second, malformed frames dropped by usbtool, unknown codes read on each
+square and reads of each calibrated code variant of each piece.
+
+Counters cover rolling windows of READING_STATS_WINDOW seconds. Within a
+window, only the number of reads of each distinct frame is counted, which is a
+single dict update per frame. Frames are decoded into cell codes when the
+window closes (or when too many distinct frames were read), so the cost does
+not depend on how fast the board is read.
+
+With --reading-stats PATH, the statistics of each window are written to PATH
+as JSON.
+"""
+import json
+import os
+from collections import Counter
+
+import chess
+
+from utils.calibration import CALIBRATION_ORDER, CELL_SIZE
+from utils.framing import cell_keys
+from utils.logger import get_logger
+
+log = get_logger()
+
+READING_STATS_WINDOW = 60  # seconds
+# Distinct frames counted before they are decoded, within a window
+MAX_PENDING_FRAMES = 256
+
+ALL_CELLS = range(64)
+
+
+class ReadingStats:
+    def __init__(self, now, window=READING_STATS_WINDOW, dump_path=None):
+        self.window = window
+        self.dump_path = dump_path
+        self.start_time = now
+        self.last_frame_time = None
+
+        # Since start
+        self.total_readings = 0
+        self.total_frames = 0
+        self.total_dropped = 0
+        self.total_skipped = 0
+
+        # Current window
+        self.window_start = now
+        self.readings = 0
+        self.frames = 0
+        self.dropped = 0
+        # Readings of frames skipped by the shared memory transport (their
+        # codes are unknown)
+        self.skipped = 0
+        # Frame codes -> board readings, not yet decoded
+        self.pending_frames = Counter()
+        # Board readings with an unknown code in each cell (a8 first, h1 last)
+        self.unknown_reads = [0] * 64
+        # Packed cell key -> board readings
+        self.key_reads = Counter()
+
+        # Statistics of the last complete window
+        self.last_window = None
+
+    def add(self, frames, calibration_index, now):
+        """
+        Count frames received by BoardReader.update (possibly none)
+        """
+        for frame in frames:
+            self.pending_frames[frame.codes] += frame.repeats
+            self.readings += frame.repeats
+            self.skipped += frame.skipped
+            self.dropped += frame.dropped
+        if frames:
+            self.frames += len(frames)
+            self.last_frame_time = now
+            if len(self.pending_frames) >= MAX_PENDING_FRAMES:
+                self._decode_pending(calibration_index)
+
+        if now >= self.window_start + self.window:
+            self.last_window = self._window_stats(calibration_index, now)
+            self._new_window(now)
+            if self.dump_path is not None:
+                self.dump(calibration_index, now)
+
+    def _decode_pending(self, calibration_index):
+        pieces = calibration_index.pieces
+        unknown_reads = self.unknown_reads
+        key_reads = self.key_reads
+        for codes, reads in self.pending_frames.items():
+            keys = cell_keys(codes)
+            # Unknown codes are counted too, and ignored in the statistics
+            if reads == 1:
+                key_reads.update(keys)
+            else:
+                for key, count in Counter(keys).items():
+                    key_reads[key] += count * reads
+            if pieces.keys() >= set(keys):
+                continue
+            for cell, key in zip(ALL_CELLS, keys):
+                if key not in pieces:
+                    unknown_reads[cell] += reads
+        self.pending_frames.clear()
+
+    def _new_window(self, now):
+        self.total_readings += self.readings
+        self.total_frames += self.frames
+        self.total_dropped += self.dropped
+        self.total_skipped += self.skipped
+        self.window_start = now
+        self.readings = self.frames = self.dropped = self.skipped = 0
+        self.unknown_reads = [0] * 64
+        self.key_reads = Counter()
+
+    def _window_stats(self, calibration_index, now):
+        self._decode_pending(calibration_index)
+        elapsed = max(now - self.window_start, 1e-9)
+        readings = max(self.readings, 1)
+        return {
+            "start_time": self.window_start,
+            "seconds": elapsed,
+            "readings_per_second": (self.readings + self.skipped) / elapsed,
+            "frames_per_second": self.frames / elapsed,
+            "readings": self.readings,
+            "frames": self.frames,
+            "dropped_frames": self.dropped,
+            "skipped_readings": self.skipped,
+            # Codes read in a square that match no calibrated code exactly
+            "unknown_rate": {
+                chess.SQUARE_NAMES[cell ^ 56]: self.unknown_reads[cell] / readings
+                for cell in ALL_CELLS
+            },
+            # Reads of each calibrated code variant (in calibration order)
+            "variant_reads": {
+                letter: [
+                    {
+                        "code": list(key.to_bytes(CELL_SIZE, "big")),
+                        "reads": self.key_reads[key],
+                    }
+                    for key in calibration_index.codes[letter]
+                ]
+                for letter in CALIBRATION_ORDER
+            },
+        }
+
+    def stats(self, calibration_index, now):
+        """
+        Return statistics of the last complete window (of the current one until
+        a window is complete), with totals since start and seconds since the
+        last frame (None if no frame was read)
+        """
+        window_stats = self.last_window
+        if window_stats is None:
+            window_stats = self._window_stats(calibration_index, now)
+        return {
+            **window_stats,
+            "total_readings": self.total_readings + self.readings,
+            "total_frames": self.total_frames + self.frames,
+            "total_dropped_frames": self.total_dropped + self.dropped,
+            "total_skipped_readings": self.total_skipped + self.skipped,
+            "seconds_since_frame": (
+                None if self.last_frame_time is None else now - self.last_frame_time
+            ),
+            "uptime": now - self.start_time,
+        }
+
+    def dump(self, calibration_index, now):
+        temp_path = f"{self.dump_path}.tmp"
+        try:
+            with open(temp_path, "w", encoding="utf-8") as file:
+                json.dump(self.stats(calibration_index, now), file, indent=1)
+            os.replace(temp_path, self.dump_path)
+        except OSError as exc:
+            log.warning(f"Could not write reading statistics: {exc}")
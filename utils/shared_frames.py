@@ -0,0 +1,259 @@
+"""
+Shared memory transport between usbtool (running in a separate process) and the
+main process. It is an alternative to the multiprocessing queues, which pickle
+every frame and copy it through a pipe.
+
+Both classes implement the subset of the queue interface that is used by
+usbtool, BoardReader and LedWriter, so they can be swapped for
+QUEUE_FROM_USBTOOL and QUEUE_TO_USBTOOL. They are pickled by name, so the
+child process attaches to the same memory block.
+"""
+import math
+import multiprocessing
+import queue
+import struct
+from multiprocessing import shared_memory
+
+from utils.framing import FRAME_TOKENS, BoardFrame
+from utils.led_animation import MAX_PATTERN_FRAMES, LedPattern
+
+_SEQ = struct.Struct("Q")
+# Repeats and receive time (NaN if unknown) of a frame, and board readings and
+# dropped frames of all frames written up to that one
+_FRAME_INFO = struct.Struct("QdQQ")
+# Flags, number of LED frames and period of a LED message
+_LED_INFO = struct.Struct("QQd")
+_LED_FRAMES_OFFSET = _SEQ.size + _LED_INFO.size
+
+
+class SharedFrameRing:
+    """
+    Fixed-slot ring of decoded frames with a sequence counter.
+
+    Layout: [write seq][slot 0 seq][slot 0 frame info][slot 0 codes]...
+
+    There is a single writer (usbtool), which never blocks: a reader that falls
+    behind simply skips the frames that were overwritten. Each slot stores the
+    sequence number of the frame it contains, which is zeroed while the frame is
+    being written and re-checked after reading to discard torn reads.
+
+    Each slot also holds the running totals of readings and dropped frames, so
+    that the frames a reader skips are still accounted for: their dropped
+    frames are added to those of the next frame it reads, and their readings
+    are given as its skipped readings.
+    """
+
+    def __init__(self, n_slots=16, name=None):
+        self.n_slots = n_slots
+        self.slot_size = _SEQ.size + _FRAME_INFO.size + FRAME_TOKENS
+        self.owner = name is None
+        if self.owner:
+            self.shm = shared_memory.SharedMemory(
+                create=True, size=_SEQ.size + n_slots * self.slot_size
+            )
+            self.shm.buf[:] = bytes(self.shm.size)
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+        self.buf = self.shm.buf
+        self.write_seq = self.read_seq = self._last_seq()
+        # Readings and dropped frames up to the last frame written and read
+        self.write_totals = self.read_totals = self._totals(self.write_seq)
+
+    def __getstate__(self):
+        return {"n_slots": self.n_slots, "name": self.shm.name}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def _last_seq(self):
+        return _SEQ.unpack_from(self.buf, 0)[0]
+
+    def _slot_offset(self, seq):
+        return _SEQ.size + (seq % self.n_slots) * self.slot_size
+
+    def _totals(self, seq):
+        if seq == 0:
+            return (0, 0)
+        return _FRAME_INFO.unpack_from(self.buf, self._slot_offset(seq) + _SEQ.size)[2:]
+
+    def put(self, frame, block=True, timeout=None):
+        # pylint: disable=unused-argument
+        self.write_seq += 1
+        total_readings, total_dropped = self.write_totals
+        self.write_totals = (
+            total_readings + frame.repeats,
+            total_dropped + frame.dropped,
+        )
+        offset = self._slot_offset(self.write_seq)
+        _SEQ.pack_into(self.buf, offset, 0)
+        _FRAME_INFO.pack_into(
+            self.buf,
+            offset + _SEQ.size,
+            frame.repeats,
+            math.nan if frame.time is None else frame.time,
+            *self.write_totals,
+        )
+        codes_offset = offset + _SEQ.size + _FRAME_INFO.size
+        self.buf[codes_offset : codes_offset + FRAME_TOKENS] = frame.codes
+        _SEQ.pack_into(self.buf, offset, self.write_seq)
+        _SEQ.pack_into(self.buf, 0, self.write_seq)
+
+    put_nowait = put
+
+    def _read(self, seq):
+        """
+        Copy frame with sequence number seq, or return None if it was overwritten
+        """
+        offset = self._slot_offset(seq)
+        if _SEQ.unpack_from(self.buf, offset)[0] != seq:
+            return None
+        repeats, frame_time, total_readings, total_dropped = _FRAME_INFO.unpack_from(
+            self.buf, offset + _SEQ.size
+        )
+        codes_offset = offset + _SEQ.size + _FRAME_INFO.size
+        codes = bytes(self.buf[codes_offset : codes_offset + FRAME_TOKENS])
+        if _SEQ.unpack_from(self.buf, offset)[0] != seq:
+            return None
+
+        # Frames skipped since the last one read are accounted for by this one
+        read_readings, read_dropped = self.read_totals
+        self.read_totals = (total_readings, total_dropped)
+        return BoardFrame(
+            codes,
+            repeats,
+            total_dropped - read_dropped,
+            None if math.isnan(frame_time) else frame_time,
+            total_readings - read_readings - repeats,
+        )
+
+    def empty(self):
+        return self._last_seq() == self.read_seq
+
+    def get_latest(self, n_frames):
+        """
+        Return (up to) the n_frames most recent unread frames, oldest first.
+        Older unread frames are skipped (and counted in the skipped readings
+        and dropped frames of the first frame returned).
+        """
+        last_seq = self._last_seq()
+        first_seq = max(self.read_seq + 1, last_seq - n_frames + 1, 1)
+        self.read_seq = last_seq
+        frames = (self._read(seq) for seq in range(first_seq, last_seq + 1))
+        return [frame for frame in frames if frame is not None]
+
+    def get_nowait(self):
+        last_seq = self._last_seq()
+        while self.read_seq < last_seq:
+            # Skip frames that were already overwritten
+            self.read_seq = max(self.read_seq + 1, last_seq - self.n_slots + 1)
+            frame = self._read(self.read_seq)
+            if frame is not None:
+                return frame
+        raise queue.Empty
+
+    def get(self, block=True, timeout=None):
+        # pylint: disable=unused-argument
+        return self.get_nowait()
+
+    def close(self):
+        self.buf = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+class SharedLedSlot:
+    """
+    Single slot holding the most recent LED message for usbtool.
+
+    usbtool only ever sends the newest LED message, so older ones can simply be
+    overwritten. A message is 8 bytes, or the frames and period of a LedPattern,
+    plus flags used to tell patterns apart and to transmit the kill command (the
+    ellipsis put by usbtool thread.kill). A pipe is used as doorbell so that
+    usbtool can wait for new messages with select.
+
+    Layout: [seq][flags][number of frames][period][8 led bytes per frame]
+    """
+
+    FLAG_KILL = 1
+    FLAG_PATTERN = 2
+
+    def __init__(self, name=None, doorbell=None):
+        self.owner = name is None
+        if self.owner:
+            self.shm = shared_memory.SharedMemory(
+                create=True, size=_LED_FRAMES_OFFSET + 8 * MAX_PATTERN_FRAMES
+            )
+            self.shm.buf[:] = bytes(self.shm.size)
+            doorbell = multiprocessing.Pipe(duplex=False)
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+        self.doorbell = doorbell
+        self.buf = self.shm.buf
+        self.write_seq = self.read_seq = _SEQ.unpack_from(self.buf, 0)[0]
+
+    def __getstate__(self):
+        return {"name": self.shm.name, "doorbell": self.doorbell}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def put(self, message, block=True, timeout=None):
+        # pylint: disable=unused-argument
+        if message is ...:
+            flags, frames, period = self.FLAG_KILL, b"", 0
+        elif isinstance(message, LedPattern):
+            if len(message.frames) > MAX_PATTERN_FRAMES:
+                raise ValueError(f"LED pattern has {len(message.frames)} frames")
+            flags, frames, period = (
+                self.FLAG_PATTERN,
+                b"".join(message.frames),
+                message.period,
+            )
+        else:
+            flags, frames, period = 0, message, 0
+
+        self.write_seq += 1
+        _SEQ.pack_into(self.buf, 0, 0)
+        _LED_INFO.pack_into(self.buf, _SEQ.size, flags, len(frames) // 8, period)
+        self.buf[_LED_FRAMES_OFFSET : _LED_FRAMES_OFFSET + len(frames)] = frames
+        _SEQ.pack_into(self.buf, 0, self.write_seq)
+        self.doorbell[1].send_bytes(b"\0")
+
+    put_nowait = put
+
+    def get_nowait(self):
+        seq = _SEQ.unpack_from(self.buf, 0)[0]
+        if seq in (0, self.read_seq):
+            raise queue.Empty
+        flags, n_frames, period = _LED_INFO.unpack_from(self.buf, _SEQ.size)
+        message = bytes(
+            self.buf[_LED_FRAMES_OFFSET : _LED_FRAMES_OFFSET + 8 * n_frames]
+        )
+        if _SEQ.unpack_from(self.buf, 0)[0] != seq:
+            # Overwritten while reading: the doorbell will wake us up again
+            raise queue.Empty
+        self.read_seq = seq
+        self.clear_wakeup()
+        if flags & self.FLAG_KILL:
+            return ...
+        if flags & self.FLAG_PATTERN:
+            frames = tuple(message[i : i + 8] for i in range(0, len(message), 8))
+            return LedPattern(frames, period)
+        return message
+
+    def empty(self):
+        return _SEQ.unpack_from(self.buf, 0)[0] in (0, self.read_seq)
+
+    def fileno(self):
+        return self.doorbell[0].fileno()
+
+    def clear_wakeup(self):
+        while self.doorbell[0].poll():
+            self.doorbell[0].recv_bytes()
+
+    def close(self):
+        self.buf = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
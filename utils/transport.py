@@ -0,0 +1,593 @@
+"""
+Board I/O shared by usbtool, bluetoothtool and the lichess readers.
+
+A BoardTransport connects to one kind of board source (serial port or RFCOMM
+socket) and hands out raw bytes. BoardLink runs a transport on an asyncio loop
+and does everything else once: splitting and decoding frames, dropping
+unchanged frames, scheduling LED writes and animations, recording and
+reconnecting.
+
+Reads wait for the file descriptor of the port in the event loop. This is only
+done on Linux: the kqueue selector used by asyncio on macOS does not support tty
+devices. Elsewhere (or with --polling-io) they poll every 1ms instead.
+"""
+import asyncio
+import multiprocessing
+import multiprocessing.queues
+import os
+import queue
+import select
+import sys
+import time
+
+import serial
+
+from utils import latency
+from utils.capture import CaptureWriter
+from utils.framing import BoardFrame, FrameBuffer, decode_frame
+from utils.latency import LatencyHistogram
+from utils.led_animation import LedAnimator, LedPattern
+from utils.led_scheduler import LedScheduler
+from utils.logger import cfg, get_logger
+
+log = get_logger()
+
+POLL_INTERVAL = 0.001  # seconds
+RECONNECT_RETRY_DELAY = 0.25  # seconds
+
+
+class WakeupQueue(queue.Queue):
+    """
+    Thread queue that can be waited on with select, together with the board port.
+
+    Every put writes one byte to a pipe, so that the reading end becomes readable
+    whenever there are new items. Pipes are only selectable on posix systems, so
+    elsewhere it behaves as a regular queue and fileno() returns None.
+    """
+
+    def __init__(self, maxsize=0):
+        super().__init__(maxsize)
+        self._wakeup_reader = self._wakeup_writer = None
+        if os.name == "posix":
+            self._wakeup_reader, self._wakeup_writer = os.pipe()
+            os.set_blocking(self._wakeup_reader, False)
+            os.set_blocking(self._wakeup_writer, False)
+
+    def put(self, item, block=True, timeout=None):
+        super().put(item, block, timeout)
+        if self._wakeup_writer is not None:
+            try:
+                os.write(self._wakeup_writer, b"\0")
+            except BlockingIOError:
+                # Pipe is full, so consumer will wake up anyway
+                pass
+
+    def fileno(self):
+        return self._wakeup_reader
+
+    def clear_wakeup(self):
+        if self._wakeup_reader is not None:
+            try:
+                while os.read(self._wakeup_reader, 4096):
+                    pass
+            except BlockingIOError:
+                pass
+
+
+def queue_fileno(queue_obj):
+    """
+    Return a file descriptor that becomes readable when queue_obj has new items,
+    or None if the queue cannot be waited on
+    """
+    if hasattr(queue_obj, "fileno"):
+        # WakeupQueue and SharedLedSlot
+        return queue_obj.fileno()
+    if isinstance(queue_obj, multiprocessing.queues.Queue):
+        # pylint: disable=protected-access
+        return queue_obj._reader.fileno()
+        # pylint: enable=protected-access
+    return None
+
+
+def event_driven():
+    return sys.platform.startswith("linux") and not cfg.args.polling_io
+
+
+async def wait_readable(file_descriptor):
+    """
+    Wait until file_descriptor is readable. Returns False if that is not
+    possible, in which case it just sleeps for POLL_INTERVAL.
+    """
+    if file_descriptor is None or not event_driven():
+        await asyncio.sleep(POLL_INTERVAL)
+        return False
+
+    loop = asyncio.get_running_loop()
+    ready = loop.create_future()
+    loop.add_reader(file_descriptor, lambda: ready.done() or ready.set_result(None))
+    try:
+        await ready
+    finally:
+        loop.remove_reader(file_descriptor)
+    return True
+
+
+class BoardTransport:
+    """
+    Source of raw board data.
+
+    open() is blocking and runs in a worker thread. find_address (if given) is
+    used to locate the board when no address was given and on reconnections.
+    """
+
+    description = "board"
+
+    def __init__(self, address, find_address=None):
+        self.address = address
+        self.find_address = find_address
+        self.connected_once = False
+
+    def locate(self):
+        if self.find_address is not None and (
+            self.connected_once or self.address is None
+        ):
+            self.address = self.find_address()
+        return self.address
+
+    def open(self, address):
+        raise NotImplementedError
+
+    def fileno(self):
+        return None
+
+    def read_available(self):
+        """
+        Return bytes received so far without blocking (b"" if there are none)
+        """
+        raise NotImplementedError
+
+    async def read(self):
+        """
+        Wait for new data. Raises OSError if connection is lost.
+        """
+        while True:
+            ready = await wait_readable(self.fileno() if event_driven() else None)
+            data = self.read_available()
+            if data:
+                return data
+            if ready:
+                raise ConnectionError(
+                    "Port reports readiness to read but returned no data"
+                )
+
+    def write(self, data):
+        raise NotImplementedError
+
+    def close(self):
+        raise NotImplementedError
+
+
+class SerialTransport(BoardTransport):
+    description = "serial port"
+
+    def __init__(self, address, find_address=None, lock=False):
+        super().__init__(address, find_address)
+        self.lock = lock
+        self.port = None
+
+    def open(self, address):
+        self.port = serial.Serial(address, 38400, timeout=2.5)
+        if self.lock and os.name == "posix":
+            import fcntl  # pylint: disable=import-outside-toplevel
+
+            fcntl.flock(self.port.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+    def fileno(self):
+        return self.port.fileno()
+
+    def read_available(self):
+        n_bytes = self.port.in_waiting
+        if n_bytes:
+            return self.port.read(n_bytes)
+        return b""
+
+    def write(self, data):
+        self.port.reset_output_buffer()
+        self.port.write(data)
+
+    def close(self):
+        if self.port is not None:
+            self.port.close()
+            self.port = None
+
+
+class BluetoothTransport(BoardTransport):
+    """
+    RFCOMM connection to bluetooth_server.py (needs pybluez)
+    """
+
+    description = "bluetooth device"
+
+    def __init__(self, address, find_address=None, channel=None):
+        super().__init__(address, find_address)
+        self.channel = cfg.BTPORT if channel is None else channel
+        self.socket = None
+
+    def open(self, address):
+        import bluetooth  # pylint: disable=import-outside-toplevel
+
+        self.socket = bluetooth.BluetoothSocket(bluetooth.RFCOMM)
+        self.socket.connect((address, self.channel))
+
+    def fileno(self):
+        return self.socket.fileno()
+
+    def read_available(self):
+        readable, _, _ = select.select([self.socket], [], [], 0)
+        if not readable:
+            return b""
+        data = self.socket.recv(4096)
+        # If no data, port is probably closed
+        if not data:
+            raise ConnectionError("Lost connection to device: no data")
+        return data
+
+    def write(self, data):
+        self.socket.send(data)
+
+    def close(self):
+        if self.socket is not None:
+            self.socket.close()
+            self.socket = None
+
+
+class BoardLink:
+    """
+    Runs a BoardTransport: every new board frame is passed to on_frame (as a
+    BoardFrame) and LED messages given to send_leds are written to the board.
+
+    Only the most recent frame of each read is forwarded, and, if a
+    ChangeFilter is given, unchanged frames are dropped. LED writes go through a
+    LedScheduler with the given minimum interval. LED messages can also be
+    LedPatterns (see utils.led_animation), whose frames are played here until
+    the next message. On any I/O error the transport
+    is closed and reopened every RECONNECT_RETRY_DELAY seconds. The last LED
+    message is written again after reconnecting, and the reconnection time is
+    logged. on_connect is an optional coroutine function that is awaited with
+    the link each time the transport is opened, before reading starts.
+    """
+
+    stats_interval = 10  # seconds
+
+    def __init__(
+        self,
+        name,
+        transport,
+        on_frame,
+        change_filter=None,
+        led_interval_ms=0,
+        record_path=None,
+        on_connect=None,
+    ):
+        self.name = name
+        self.transport = transport
+        self.on_frame = on_frame
+        self.change_filter = change_filter
+        self.on_connect = on_connect
+        self.frame_buffer = FrameBuffer()
+        self.led_scheduler = LedScheduler(led_interval_ms)
+        self.led_animator = LedAnimator()
+        self.recorder = CaptureWriter(record_path) if record_path else None
+
+        self.connected = False
+        self.disconnect_time = None
+        self.reconnect_times = LatencyHistogram()
+
+        self.loop = None
+        self.main_task = None
+        self.reader = None
+        self.write_error = None
+        self.led_event = None
+        self.animation_event = None
+
+        self.last_reading_time = time.time()
+        # Malformed frames not yet reported with a forwarded frame
+        self.dropped_frames = 0
+        self.wakeups = 0
+        self.stats_time = time.time()
+        self.stats_cpu_time = time.thread_time()
+
+    def send_leds(self, message):
+        """
+        Schedule LED message or LedPattern (can be called from any thread)
+        """
+        if self.loop is None:
+            self._schedule_leds(message, time.time())
+        else:
+            self.loop.call_soon_threadsafe(self._submit_leds, message)
+
+    def stop(self):
+        """
+        Stop run() (can be called from any thread)
+        """
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.main_task.cancel)
+
+    def _schedule_leds(self, message, now):
+        if isinstance(message, LedPattern):
+            # Keep the pace of a pattern that is sent again
+            if message == self.led_animator.pattern:
+                return
+            # Time the pattern from when its first frame (the flashing LEDs on)
+            # can be written, so that it is shown for a whole period even if the
+            # previous LED write was recent
+            scheduler = self.led_scheduler
+            start_time = max(now, scheduler.last_write_time + scheduler.min_interval)
+            message = self.led_animator.play(
+                message, start_time, scheduler.min_interval
+            )
+        else:
+            self.led_animator.stop()
+        self.led_scheduler.submit(message, now)
+
+    def _submit_leds(self, message):
+        self._schedule_leds(message, time.time())
+        self.led_event.set()
+        self.animation_event.set()
+
+    async def run(self, led_queue=None, stop_event=None):
+        """
+        Run until stopped. LED messages can also be read from led_queue (where
+        an ellipsis stops the link), and a threading.Event can stop it too.
+        """
+        log.debug(
+            f"{self.name}: using {'event-driven' if event_driven() else 'polling'} I/O"
+        )
+        self.loop = asyncio.get_running_loop()
+        self.main_task = asyncio.current_task()
+        if multiprocessing.parent_process() is not None:
+            # LED writes are traced in this process, which logs them itself
+            latency.install()
+        self.led_event = asyncio.Event()
+        self.animation_event = asyncio.Event()
+
+        tasks = [
+            asyncio.ensure_future(self._write_leds()),
+            asyncio.ensure_future(self._animate_leds()),
+        ]
+        if led_queue is not None:
+            tasks.append(asyncio.ensure_future(self._read_led_queue(led_queue)))
+        if stop_event is not None:
+            tasks.append(asyncio.ensure_future(self._wait_stop_event(stop_event)))
+
+        try:
+            while True:
+                await self._connect()
+                self.reader = asyncio.ensure_future(self._read_frames())
+                try:
+                    await asyncio.wait([self.reader])
+                except asyncio.CancelledError:
+                    self.reader.cancel()
+                    raise
+                if self.reader.cancelled():
+                    exc = self.write_error
+                else:
+                    exc = self.reader.exception()
+                if exc is None:
+                    # Reader was cancelled without a write error
+                    raise asyncio.CancelledError()
+                if not isinstance(exc, OSError):
+                    raise exc
+                log.warning(
+                    f"{self.name}: lost connection to "
+                    f"{self.transport.description}: {exc}"
+                )
+                self._disconnect()
+        except asyncio.CancelledError:
+            pass
+        finally:
+            for task in tasks:
+                task.cancel()
+            self._shutdown()
+
+    async def _connect(self):
+        while True:
+            address = await self.loop.run_in_executor(None, self.transport.locate)
+            if address is None:
+                await asyncio.sleep(RECONNECT_RETRY_DELAY)
+                continue
+            try:
+                await self.loop.run_in_executor(None, self.transport.open, address)
+                if self.on_connect is not None:
+                    await self.on_connect(self)
+            # pylint: disable=broad-except
+            except Exception as exc:
+                # pylint: enable=broad-except
+                log.warning(f"{self.name}: failed to (re)connect to {address}: {exc}")
+                self.transport.close()
+                await asyncio.sleep(RECONNECT_RETRY_DELAY)
+                continue
+            break
+
+        log.debug(f"{self.name}: connected to {address}")
+        self.frame_buffer.clear()
+        if self.change_filter is not None:
+            self.change_filter.reset()
+        if self.transport.connected_once:
+            now = time.time()
+            self.led_scheduler.reconnected(now)
+            reconnect_ms = (now - self.disconnect_time) * 1000
+            self.reconnect_times.add(reconnect_ms)
+            log.info(f"{self.name}: reconnected to {address} in {reconnect_ms:.0f}ms")
+        self.transport.connected_once = True
+        self.connected = True
+        self.write_error = None
+        self.led_event.set()
+
+    def _disconnect(self):
+        self.connected = False
+        self.disconnect_time = time.time()
+        self.transport.close()
+
+    async def _read_frames(self):
+        while True:
+            data = await self.transport.read()
+            self._count_wakeup()
+            self._process(data)
+
+    def _process(self, data):
+        now = time.time()
+        self.frame_buffer.feed(data)
+        lines = self.frame_buffer.pop_frames()
+        if self.recorder is not None:
+            self.recorder.write_lines(lines, now)
+
+        # Only the most recent complete frame is forwarded, older ones in the
+        # same batch are already stale. All malformed lines are counted though
+        codes = None
+        for line in reversed(lines):
+            line_codes = decode_frame(line)
+            if line_codes is None:
+                self.dropped_frames += 1
+            elif codes is None:
+                codes = line_codes
+        if codes is None:
+            return
+
+        if self.change_filter is None:
+            frame = BoardFrame(codes, 1)
+        else:
+            frame = self.change_filter.filter(codes, now)
+        if frame is not None:
+            # Time the frame was received, for latency tracing
+            self.on_frame(frame._replace(dropped=self.dropped_frames, time=now))
+            self.dropped_frames = 0
+
+        if cfg.DEBUG_READING:
+            new_reading_time = time.time()
+            diff_reading_time = (new_reading_time - self.last_reading_time) * 1000
+            log.debug(f"Got reading in {diff_reading_time:.0f}ms")
+            self.last_reading_time = new_reading_time
+
+    async def _write_leds(self):
+        writes_logged = 0
+        while True:
+            delay = self.led_scheduler.time_until_due(time.time())
+            if delay is None or not self.connected:
+                await self.led_event.wait()
+                self.led_event.clear()
+                continue
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
+
+            self._count_wakeup()
+            data = self.led_scheduler.pop_due(time.time())
+            if data is None:
+                continue
+            try:
+                self.transport.write(data)
+            except OSError as exc:
+                # Try again after reconnecting, unless superseded
+                self.led_scheduler.submit(data, time.time())
+                self.write_error = exc
+                self.reader.cancel()
+                continue
+
+            self.led_scheduler.mark_written(data, time.time())
+            if self.recorder is not None:
+                self.recorder.write_leds(data, time.time())
+            if cfg.DEBUG_LED:
+                log.debug(f"Sending to board - {list(data)}")
+                if self.led_scheduler.latency.total >= writes_logged + 100:
+                    writes_logged = self.led_scheduler.latency.total
+                    log.debug(
+                        f"LED write latency: {self.led_scheduler.latency.summary()}"
+                    )
+
+    async def _animate_leds(self):
+        while True:
+            self.animation_event.clear()
+            frame_time = self.led_animator.next_frame_time()
+            if frame_time is None:
+                await self.animation_event.wait()
+                continue
+            delay = frame_time - time.time()
+            if delay > 0:
+                # Unless a new message stops or replaces the animation
+                try:
+                    await asyncio.wait_for(self.animation_event.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            self._count_wakeup()
+            frame = self.led_animator.pop_due(time.time())
+            if frame is not None:
+                self.led_scheduler.submit(frame, time.time())
+                self.led_event.set()
+
+    async def _read_led_queue(self, led_queue):
+        file_descriptor = queue_fileno(led_queue) if event_driven() else None
+        clear_wakeup = getattr(led_queue, "clear_wakeup", None)
+        while True:
+            await wait_readable(file_descriptor)
+            if clear_wakeup is not None:
+                clear_wakeup()
+            while True:
+                try:
+                    message = led_queue.get_nowait()
+                except queue.Empty:
+                    break
+                # Kill command
+                if message is ...:
+                    self.main_task.cancel()
+                    return
+                self._submit_leds(message)
+
+    async def _wait_stop_event(self, stop_event):
+        while not stop_event.is_set():
+            await asyncio.sleep(0.1)
+        self.main_task.cancel()
+
+    def _count_wakeup(self):
+        if not cfg.DEBUG_READING:
+            return
+        self.wakeups += 1
+        now = time.time()
+        if now - self.stats_time >= self.stats_interval:
+            cpu_time = time.thread_time()
+            log.debug(
+                f"{self.name}: {self.wakeups / (now - self.stats_time):.0f} "
+                f"wakeups/s, "
+                f"{(cpu_time - self.stats_cpu_time) / (now - self.stats_time):.1%} "
+                f"CPU"
+            )
+            self.wakeups = 0
+            self.stats_time = now
+            self.stats_cpu_time = cpu_time
+
+    def _shutdown(self):
+        log.debug(
+            f"{self.name}: LED write latency: {self.led_scheduler.latency.summary()}"
+        )
+        if multiprocessing.parent_process() is not None:
+            # Multiprocessing children do not run atexit handlers
+            latency.dump()
+        if self.reconnect_times.total:
+            log.debug(
+                f"{self.name}: reconnection time: {self.reconnect_times.summary()}"
+            )
+        if self.connected:
+            # Turn off LEDs
+            self.led_scheduler.submit(bytes(8), time.time())
+            wait_time = self.led_scheduler.time_until_due(time.time())
+            if wait_time > 0:
+                time.sleep(wait_time)
+            try:
+                self.transport.write(bytes(8))
+            except OSError as exc:
+                log.warning(f"{self.name}: could not turn off LEDs: {exc}")
+            self.transport.close()
+        if self.recorder is not None:
+            self.recorder.close()
@@ -1,154 +1,104 @@
+import asyncio
+import atexit
+import concurrent.futures
+import json
 import multiprocessing
+import os
 import queue
 import threading
 import time
-from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 import serial
 from serial.tools.list_ports import comports
 
-from utils.logger import cfg, get_logger
-
-QUEUE_TO_USBTOOL = queue.Queue(maxsize=64)
-QUEUE_FROM_USBTOOL = queue.Queue(maxsize=64)
-
+from utils.framing import ChangeFilter
+from utils.led_scheduler import load_min_interval_ms
+from utils.logger import CERTABO_DATA_PATH, cfg, get_logger
+from utils.shared_frames import SharedFrameRing, SharedLedSlot
+from utils.transport import BoardLink, SerialTransport, WakeupQueue
 
 log = get_logger()
 
 
-def _usbtool(address_chessboard, queue_to_usbtool, queue_from_usbtool, buffer_ms=750):
-    log.debug("Starting Usbtool")
-    log.debug(f"Usbtool buffer = {buffer_ms}ms")
-
-    socket = None
-    socket_ok = False
-    first_connection = True
-
-    time_last_message_to_board = 0
-    buffer = buffer_ms / 1000
-    message_to_board = deque(maxlen=1)
+QUEUE_TO_USBTOOL = WakeupQueue(maxsize=64)
+QUEUE_FROM_USBTOOL = queue.Queue(maxsize=64)
 
-    message_from_board = ""
-    last_reading_time = time.time()
 
-    # pylint: disable=too-many-nested-blocks
+def _usbtool(
+    address_chessboard,
+    queue_to_usbtool,
+    queue_from_usbtool,
+    led_interval_ms=750,
+    filter_frames=True,
+):
+    log.debug("Starting Usbtool")
+    log.debug(f"Usbtool minimum LED interval = {led_interval_ms}ms")
+
+    transport = SerialTransport(
+        address_chessboard,
+        find_address=find_address if cfg.args.usbport is None else None,
+    )
+    link = BoardLink(
+        "Usbtool",
+        transport,
+        queue_from_usbtool.put,
+        change_filter=ChangeFilter() if filter_frames else None,
+        led_interval_ms=led_interval_ms,
+        record_path=cfg.args.record,
+    )
     try:
-        while True:
-            time.sleep(0.001)
-
-            # Try to (re)connect to board
-            if not socket_ok:
-                try:
-                    if not first_connection:
-                        socket.close()
-                        address_chessboard = (
-                            find_address()
-                            if cfg.args.usbport is None
-                            else cfg.args.usbport
-                        )
-                        if address_chessboard is None:
-                            time.sleep(0.5)
-                            continue
-
-                    socket = serial.Serial(address_chessboard, 38400, timeout=2.5)
-
-                # pylint: disable=broad-except
-                except Exception as exc:
-                    # pylint: enable=broad-except
-                    log.warning(
-                        f"Failed to (re)connect to port {address_chessboard}: {exc}"
-                    )
-                    time.sleep(1)
-                    continue
-
-                else:
-                    socket_ok = True
-                    if first_connection:
-                        first_connection = False
-
-            # Store message to board
-            try:
-                new_message = queue_to_usbtool.get_nowait()
-                # Kill command
-                if new_message is ...:
-                    break
-                message_to_board.append(new_message)
-            except queue.Empty:
-                pass
-
-            # Send message to board
-            if message_to_board and time.time() >= time_last_message_to_board + buffer:
-                data = message_to_board.pop()
-                try:
-                    socket.reset_output_buffer()
-                    socket.write(data)
-                # pylint: disable=broad-except
-                except Exception as exc:
-                    # pylint: enable=broad-except
-                    log.warning(f"Could not write to serial port {exc}")
-                    socket_ok = False
-                    continue
-                else:  # No Exception
-                    time_last_message_to_board = time.time()
-                    if cfg.DEBUG_LED:
-                        log.debug(f"Sending to board - {list(data)}")
-
-            # Read messages from board
-            try:
-                while socket.inWaiting():
-                    char = socket.read().decode("ISO-8859-1")
-
-                    # Look for newline
-                    if char != "\n":
-                        message_from_board += char
-                    else:
-                        message_from_board = message_from_board[
-                            :-2
-                        ]  # Remove trailing ' /r'
-                        if len(message_from_board.split(" ")) == 320:  # 64*5
-                            queue_from_usbtool.put(message_from_board)
-
-                        message_from_board = ""
-                        socket.reset_input_buffer()
-                        if cfg.DEBUG_READING:
-                            new_reading_time = time.time()
-                            diff_reading_time = (
-                                new_reading_time - last_reading_time
-                            ) * 1000
-                            log.debug(f"Got reading in {diff_reading_time:.0f}ms")
-                            last_reading_time = new_reading_time
-
-            # pylint: disable=broad-except
-            except Exception as exc:
-                # pylint: enable=broad-except
-                log.warning(f"Could not read from serial port: {exc}")
-                socket_ok = False
-
+        asyncio.run(link.run(led_queue=queue_to_usbtool))
     except KeyboardInterrupt:
         pass
-    finally:
-        log.debug("Quitting usbtool")
-        if socket is not None:
-            wait_time = buffer - (time.time() - time_last_message_to_board)
-            if wait_time > 0:
-                time.sleep(wait_time)
-            socket.write(bytes([0, 0, 0, 0, 0, 0, 0, 0]))
-            socket.close()
-    # pylint: enable=too-many-nested-blocks
+    log.debug("Quitting usbtool")
 
 
-def start_usbtool(address_chessboard, buffer_ms=750, separate_process=False):
+def start_usbtool(
+    address_chessboard,
+    led_interval_ms=None,
+    separate_process=False,
+    transport="queue",
+    filter_frames=True,
+):
+    """
+    Launch usbtool in a separate thread or process.
+
+    led_interval_ms is the minimum time between LED messages (by default, see
+    led_scheduler.load_min_interval_ms).
+
+    When running in a separate process, transport="shared_memory" replaces the
+    multiprocessing queues by a shared memory frame ring and LED slot.
+
+    With filter_frames=False every board reading is forwarded, instead of
+    dropping unchanged frames (see framing.ChangeFilter)
+    """
 
     global QUEUE_TO_USBTOOL
     global QUEUE_FROM_USBTOOL
 
+    if led_interval_ms is None:
+        led_interval_ms = load_min_interval_ms()
+
     if separate_process:
-        log.debug("Launching Usbtool in separate process")
-        QUEUE_FROM_USBTOOL = multiprocessing.Queue(maxsize=64)
-        QUEUE_TO_USBTOOL = multiprocessing.Queue(maxsize=64)
+        log.debug(f"Launching Usbtool in separate process ({transport} transport)")
+        if transport == "shared_memory":
+            QUEUE_FROM_USBTOOL = SharedFrameRing()
+            QUEUE_TO_USBTOOL = SharedLedSlot()
+            atexit.register(QUEUE_FROM_USBTOOL.close)
+            atexit.register(QUEUE_TO_USBTOOL.close)
+        else:
+            QUEUE_FROM_USBTOOL = multiprocessing.Queue(maxsize=64)
+            QUEUE_TO_USBTOOL = multiprocessing.Queue(maxsize=64)
         thread = multiprocessing.Process(
             target=_usbtool,
-            args=(address_chessboard, QUEUE_TO_USBTOOL, QUEUE_FROM_USBTOOL, buffer_ms),
+            args=(
+                address_chessboard,
+                QUEUE_TO_USBTOOL,
+                QUEUE_FROM_USBTOOL,
+                led_interval_ms,
+                filter_frames,
+            ),
             daemon=True,
         )
         thread.start()
@@ -157,7 +107,13 @@ def start_usbtool(address_chessboard, buffer_ms=750, separate_process=False):
         log.debug("Launching Usbtool in separate thread")
         thread = threading.Thread(
             target=_usbtool,
-            args=(address_chessboard, QUEUE_TO_USBTOOL, QUEUE_FROM_USBTOOL, buffer_ms),
+            args=(
+                address_chessboard,
+                QUEUE_TO_USBTOOL,
+                QUEUE_FROM_USBTOOL,
+                led_interval_ms,
+                filter_frames,
+            ),
             daemon=True,
         )
         thread.start()
@@ -167,6 +123,98 @@ def start_usbtool(address_chessboard, buffer_ms=750, separate_process=False):
     return thread
 
 
+CERTABO_USB_IDS = (0x10C4, 0xEA60)  # Silicon Labs CP210x (VID, PID)
+PROBE_TIMEOUT = 0.5  # seconds
+LAST_DEVICE_FILEPATH = os.path.join(CERTABO_DATA_PATH, "last_usb_device.json")
+LAST_DEVICE_KEYS = ("device", "vid", "pid", "serial_number")
+
+
+def _load_last_device():
+    try:
+        with open(LAST_DEVICE_FILEPATH, "r", encoding="utf-8") as file:
+            device = json.load(file)
+    except (OSError, ValueError):
+        return None
+    # Ignore a partial or hand-edited file
+    if not isinstance(device, dict) or not all(
+        key in device for key in LAST_DEVICE_KEYS
+    ):
+        log.debug(f"Ignoring invalid {LAST_DEVICE_FILEPATH}")
+        return None
+    return device
+
+
+def _save_last_device(port):
+    device = {
+        "device": port.device,
+        "vid": port.vid,
+        "pid": port.pid,
+        "serial_number": port.serial_number,
+    }
+    if device == _load_last_device():
+        return
+    log.debug(f"Remembering USB device {device}")
+    try:
+        with open(LAST_DEVICE_FILEPATH, "w", encoding="utf-8") as file:
+            json.dump(device, file)
+    except OSError as exc:
+        log.warning(f"Could not save last USB device: {exc}")
+
+
+def _is_last_device(port, last_device):
+    """
+    Match by USB identity if the device has a serial number (the port name may
+    change when it re-enumerates), otherwise by port name
+    """
+    if last_device is None:
+        return False
+    if port.serial_number:
+        return (port.vid, port.pid, port.serial_number) == (
+            last_device["vid"],
+            last_device["pid"],
+            last_device["serial_number"],
+        )
+    return port.device == last_device["device"]
+
+
+def test_availability(device, description):
+    """
+    Helper method to check if port is available.
+    """
+    try:
+        log.debug(f"Checking {device}: {description}")
+        serial_device = serial.Serial(device)
+    except serial.SerialException:
+        log.debug(f"Port {device} is busy")
+        return False
+    else:
+        serial_device.close()
+        log.debug(f"Port {device} is available")
+        return True
+
+
+def _probe_ports(ports, timeout=PROBE_TIMEOUT):
+    """
+    Test availability of all ports concurrently. Returns available ports, in the
+    same order. Ports that do not answer within timeout are considered busy.
+    """
+    if not ports:
+        return []
+    executor = ThreadPoolExecutor(max_workers=len(ports))
+    futures = [
+        executor.submit(test_availability, port.device, port.description)
+        for port in ports
+    ]
+    concurrent.futures.wait(futures, timeout)
+    # Do not wait for ports whose opening hangs
+    executor.shutdown(wait=False)
+    return [
+        port
+        for port, future in zip(ports, futures)
+        if future.done() and future.result()
+    ]
+
+
 def find_address(
     strict=cfg.args.port_not_strict,
     test_address=None,
@@ -174,60 +222,65 @@ def find_address(
     """
     Method to find Certabo Chess port.
 
-    It looks for availbale ports with the right driver in their description: 'cp210x'
+    It looks for available ports with the right driver in their description:
+    'cp210x', or with the USB ids of that driver.
 
-    If strict=False, it also looks for available serial ports missing the right driver description,
-    (but only if no available cp210x driver was found among all listed ports)
+    If strict=False, it also looks for available serial ports missing the right
+    driver description (but only if no available cp210x port was found).
 
-    If try_port: it tries only that one
-    """
+    The last port that was found is remembered (by USB serial number) and tried
+    first. Other candidates are tested concurrently.
 
-    def test_availability(device, description):
-        """
-        Helper method to check if port is available.
-        """
-        try:
-            log.debug(f"Checking {device}: {description}")
-            serial_device = serial.Serial(device)
-        except serial.SerialException:
-            log.debug("Port is busy")
-            return False
-        else:
-            serial_device.close()
-            log.debug("Port is available")
-            return True
-
-    devices_wrong_description = []
+    If test_address: it tries only that one
+    """
+    start_time = time.perf_counter()
     log.debug(f"Searching for USB devices: strict = {strict}")
     log.debug(f"test_address: {test_address}")
 
+    right_description = []
+    wrong_description = []
     for port in comports():
-        device, description = port[0], port[1]
-
         # Ignore different addresses when testing specific address
-        if (test_address is not None) and (device != test_address):
+        if (test_address is not None) and (port.device != test_address):
             continue
 
         # Look for CP210X driver in port description
-        if "cp210" in description.lower():
-            if test_availability(device, description):
-                log.debug("Returning port with right description")
-                return device
-
-        elif not strict:
-            if "bluetooth" in device.lower():
-                continue
-            if test_availability(device, description):
-                log.debug("Found port with wrong description: checking for others...")
-                devices_wrong_description.append(device)
-
-    if devices_wrong_description:
-        device = devices_wrong_description[0]
-        log.debug(
-            "Did not find port with right description: "
-            f"returning port with wrong description: {device}"
-        )
-        return devices_wrong_description[0]
+        if (
+            "cp210" in port.description.lower()
+            or (port.vid, port.pid) == CERTABO_USB_IDS
+        ):
+            right_description.append(port)
+        elif not strict and "bluetooth" not in port.device.lower():
+            wrong_description.append(port)
+
+    # Fast path: last known board
+    last_device = _load_last_device()
+    for port in right_description:
+        if _is_last_device(port, last_device):
+            if _probe_ports([port]):
+                log.debug(f"Returning last known port: {port.device}")
+                _save_last_device(port)
+                return port.device
+            right_description = [
+                other_port for other_port in right_description if other_port != port
+            ]
+            break
+
+    available = _probe_ports(right_description + wrong_description)
+    log.debug(
+        f"Probed {len(right_description) + len(wrong_description)} ports in "
+        f"{(time.perf_counter() - start_time) * 1000:.0f}ms"
+    )
+    for port in available:
+        if port in right_description:
+            log.debug(f"Returning port with right description: {port.device}")
+        else:
+            log.debug(
+                "Did not find port with right description: "
+                f"returning port with wrong description: {port.device}"
+            )
+        _save_last_device(port)
+        return port.device
 
     log.warning("No ports available")
     return None